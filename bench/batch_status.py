@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Compares two builds of the pbs_ifl binding on server-wide stats.
+
+Build the binding to compare in its own directory, e.g. the eager
+batch_status typemap of an older revision:
+
+    mkdir /tmp/old && git show <revision>:pbs_ifl.i > /tmp/old/pbs_ifl.i
+    cp Makefile /tmp/old && make -C /tmp/old
+
+and the current one by make in the source directory. Then run
+
+    bench/batch_status.py --old /tmp/old --new . [--server srv]
+
+Each binding runs in its own process (both are called pbs_ifl).
+The time of the stat call, of reading the attributes the extender uses
+and the growth of the resident memory over the iterations are printed.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# attributes the extender reads from the stat results
+ATTRS = {
+    "vnode": ["queue"],
+    "job": ["job_state", "Job_Owner", "Resource_List.walltime",
+            "exec_vnode", "exec_host", "queue", "stime"],
+    "resv": ["reserve_start", "resv_nodes"],
+}
+
+
+def rss():
+    """
+    Resident memory of the process in kB
+    """
+
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def child(args):
+    """
+    Runs the benchmark with the binding of args.child
+    """
+
+    sys.path.insert(0, os.path.abspath(args.child))
+    import pbs_ifl
+
+    stat = {"vnode": pbs_ifl.pbs_statvnode,
+            "job": pbs_ifl.pbs_statjob,
+            "resv": pbs_ifl.pbs_statresv}[args.type]
+
+    c = pbs_ifl.pbs_connect(args.server)
+    if c < 0:
+        print("Failed to connect to the server.", file=sys.stderr)
+        return 1
+
+    stat_secs = 0.0
+    access_secs = 0.0
+    objects = 0
+    rss_start = None
+
+    for i in range(args.iterations):
+        start = time.perf_counter()
+        infos = stat(c, None, None, None)
+        stat_secs += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for info in infos:
+            for attr in ATTRS[args.type]:
+                info.get(attr)
+        access_secs += time.perf_counter() - start
+
+        objects = len(infos)
+        del infos
+
+        if i == 0:
+            # the first round allocates the interpreter caches
+            rss_start = rss()
+
+    pbs_ifl.pbs_disconnect(c)
+
+    print(json.dumps({"objects": objects,
+                      "stat_ms": 1000 * stat_secs / args.iterations,
+                      "access_ms": 1000 * access_secs / args.iterations,
+                      "rss_growth_kb": rss() - rss_start}))
+
+    return 0
+
+
+def run(binding, args):
+    """
+    Runs the benchmark of the binding in a new process
+    """
+
+    cmd = [sys.executable, __file__, "--child", binding,
+           "--type", args.type, "--iterations", str(args.iterations)]
+    if args.server:
+        cmd += ["--server", args.server]
+
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+
+    return json.loads(out.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the pbs_ifl batch_status binding")
+    parser.add_argument("--old", help="directory of the old binding")
+    parser.add_argument("--new", help="directory of the new binding")
+    parser.add_argument("--server", default=None, help="PBS server")
+    parser.add_argument("--type", default="vnode", choices=ATTRS.keys(),
+                        help="objects to stat")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    if not args.old or not args.new:
+        parser.error("both --old and --new are required")
+
+    results = {"old": run(args.old, args), "new": run(args.new, args)}
+
+    print("%-6s %8s %12s %12s %14s" %
+          ("", "objects", "stat [ms]", "access [ms]", "rss growth [kB]"))
+    for name, r in results.items():
+        print("%-6s %8d %12.3f %12.3f %14d" %
+              (name, r["objects"], r["stat_ms"], r["access_ms"],
+               r["rss_growth_kb"]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the exec_vnode parsing on large jobs.
+
+Compares the former per-chunk regexp ncpus count with Exec_vnode
+of the extender on generated exec_vnode strings of --chunks vnodes,
+every one with ncpus, ngpus and mem. Besides the ncpus the time
+of all the totals (ncpus, ngpus, mem) and of the list of vnodes
+for the node checks is printed.
+
+    bench/exec_vnode.py [--chunks 1000 10000] [--iterations 100]
+
+The extender is loaded with the PBS and psycopg2 stand-ins
+of bench/fake, no PBS nor PostgreSQL is needed.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENDER = os.path.join(os.path.dirname(BENCH_DIR),
+                        "openpbs-walltime-extender.py")
+
+sys.path.insert(0, os.path.join(BENCH_DIR, "fake"))
+import psycopg2_stub
+
+
+def load_extender():
+    psycopg2_stub.install()
+
+    spec = importlib.util.spec_from_file_location("extender", EXTENDER)
+    extender = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(extender)
+
+    return extender
+
+
+def regex_ncpus(exec_vnode):
+    """
+    The former get_ncpus()
+    """
+
+    ncpus = 0
+
+    for i in exec_vnode.split("+"):
+        node_ncpus = 1
+        match = re.match(r'.*ncpus=([0-9]+).*', i)
+        if match:
+            node_ncpus *= int(match.group(1))
+        ncpus += node_ncpus
+
+    return ncpus
+
+
+def parser_ncpus(extender, exec_vnode):
+    return extender.Exec_vnode(exec_vnode).total("ncpus", 1)
+
+
+def parser_totals(extender, exec_vnode):
+    parsed = extender.Exec_vnode(exec_vnode)
+    return [parsed.total("ncpus", 1), parsed.total("ngpus"),
+            parsed.total("mem")]
+
+
+def parser_vnodes(extender, exec_vnode):
+    parsed = extender.Exec_vnode(exec_vnode)
+    return parsed.vnodes()
+
+
+def exec_vnode(chunks):
+    """
+    Generates exec_vnode of chunks vnodes, two vnodes per host chunk
+    """
+
+    vnodes = ["node%05d[%d]:ncpus=%d:ngpus=%d:mem=%dkb" %
+              (i // 2, i % 2, 16 + i % 48, i % 4, 1048576 * (1 + i % 8))
+              for i in range(chunks)]
+
+    return "+".join("(%s)" % "+".join(vnodes[i:i + 2])
+                    for i in range(0, chunks, 2))
+
+
+def measure(function, value, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(value)
+
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the exec_vnode parsing")
+    parser.add_argument("--chunks", type=int, nargs="+",
+                        default=[10, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    extender = load_extender()
+
+    print("%8s %10s %14s %14s %8s %14s %14s" %
+          ("chunks", "length", "regexp [us]", "parser [us]", "speedup",
+           "totals [us]", "vnodes [us]"))
+    for chunks in args.chunks:
+        value = exec_vnode(chunks)
+
+        if regex_ncpus(value) != parser_ncpus(extender, value):
+            print("Different ncpus of %d chunks." % chunks, file=sys.stderr)
+            return 1
+
+        old = measure(regex_ncpus, value, args.iterations)
+        new = measure(lambda v: parser_ncpus(extender, v), value,
+                      args.iterations)
+        totals = measure(lambda v: parser_totals(extender, v), value,
+                         args.iterations)
+        vnodes = measure(lambda v: parser_vnodes(extender, v), value,
+                         args.iterations)
+
+        print("%8d %10d %14.1f %14.1f %8.1f %14.1f %14.1f" %
+              (chunks, len(value), old * 10 ** 6, new * 10 ** 6, old / new,
+               totals * 10 ** 6, vnodes * 10 ** 6))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,167 @@
+"""
+In-memory stand-in of the pbs_ifl binding for the benchmarks.
+
+Jobs, nodes, queues and reservations live in module dicts filled by
+add_job(), add_node(), add_queue() and add_resv(), every call waits
+LATENCY seconds to simulate the round trip to the PBS server.
+The stat results honor the attrl list like the server does.
+"""
+
+import time
+import threading
+
+SERVER_HOST = "pbs.example"
+LATENCY = 0.0
+
+jobs = {}
+nodes = {}
+queues = {}
+resvs = {}
+calls = {}
+
+lock = threading.Lock()
+
+
+class attrl(object):
+    def __init__(self):
+        self.name = None
+        self.resource = None
+        self.value = None
+        self.next = None
+
+
+def reset():
+    for objects in [jobs, nodes, queues, resvs, calls]:
+        objects.clear()
+
+
+def add_job(jobid, owner, exec_nodes, ncpus, walltime="01:00:00",
+            state="R", queue="workq", stime=None):
+    """
+    Adds a job running on exec_nodes with ncpus per node
+    """
+
+    jobs[jobid] = {
+        "job_state": state,
+        "Job_Owner": owner,
+        "Resource_List.walltime": walltime,
+        "exec_vnode": "+".join("(%s:ncpus=%d)" % (node, ncpus)
+                               for node in exec_nodes),
+        "exec_host": "+".join("%s/0*%d" % (node, ncpus)
+                              for node in exec_nodes),
+        "queue": queue,
+        "stime": str(int(stime if stime is not None else time.time())),
+    }
+
+
+def add_node(name, queue="workq", resv=None):
+    """
+    Adds a node, optionally into the reservation resv (added before)
+    """
+
+    nodes[name] = {"queue": queue}
+    if resv:
+        nodes[name]["resv"] = resv
+        chunk = "(%s:ncpus=1)" % name
+        if "resv_nodes" in resvs[resv]:
+            chunk = resvs[resv]["resv_nodes"] + "+" + chunk
+        resvs[resv]["resv_nodes"] = chunk
+
+
+def add_queue(name, max_walltime=None):
+    queues[name] = {}
+    if max_walltime:
+        queues[name]["resources_max.walltime"] = max_walltime
+
+
+def add_resv(name, start):
+    resvs[name] = {"reserve_start": str(int(start))}
+
+
+def _call(name):
+    with lock:
+        calls[name] = calls.get(name, 0) + 1
+
+    if LATENCY > 0:
+        time.sleep(LATENCY)
+
+
+def _names(attrib):
+    names = set()
+    while attrib is not None:
+        if attrib.resource:
+            names.add("%s.%s" % (attrib.name, attrib.resource))
+        else:
+            names.add(attrib.name)
+        attrib = attrib.next
+
+    return names
+
+
+def _stat(objects, ids, attrib):
+    names = _names(attrib)
+
+    if ids:
+        ids = [i for i in ids.split(",") if i in objects]
+    else:
+        ids = list(objects.keys())
+
+    out = []
+    for i in ids:
+        info = {"id": i}
+        for key, value in objects[i].items():
+            if len(names) == 0 or key in names:
+                info[key] = value
+        out.append(info)
+
+    return out
+
+
+def pbs_connect(server):
+    _call("pbs_connect")
+    return 1
+
+
+def pbs_disconnect(c):
+    return 0
+
+
+def pbs_statserver(c, attrib, extend):
+    _call("pbs_statserver")
+    return [{"id": SERVER_HOST, "server_host": SERVER_HOST}]
+
+
+def pbs_statjob(c, ids, attrib, extend):
+    _call("pbs_statjob")
+
+    out = _stat(jobs, ids, attrib)
+    if not (extend and "x" in extend):
+        out = [info for info in out
+               if jobs[info["id"]]["job_state"] not in ["F", "M"]]
+
+    return out
+
+
+def pbs_statvnode(c, ids, attrib, extend):
+    _call("pbs_statvnode")
+    return _stat(nodes, ids, attrib)
+
+
+def pbs_statque(c, ids, attrib, extend):
+    _call("pbs_statque")
+    return _stat(queues, ids, attrib)
+
+
+def pbs_statresv(c, ids, attrib, extend):
+    _call("pbs_statresv")
+    return _stat(resvs, ids, attrib)
+
+
+def pbs_alterjob(c, jobid, attrib, extend):
+    _call("pbs_alterjob")
+
+    if jobid not in jobs:
+        return 15001
+
+    jobs[jobid]["Resource_List.walltime"] = attrib.value
+    return 0
@@ -0,0 +1,18 @@
+"""
+Stand-in of the psycopg2 import for the benchmarks not touching
+PostgreSQL, so the extender loads without the driver installed.
+"""
+
+import sys
+import types
+
+
+def install():
+    """
+    Registers an empty psycopg2 module unless the driver is installed
+    """
+
+    try:
+        import psycopg2
+    except ImportError:
+        sys.modules["psycopg2"] = types.ModuleType("psycopg2")
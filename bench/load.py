@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+"""
+Load test of the walltime extender, drives Walltime_extender end to end
+through run() as the daemon does, with warm PBS connections per thread.
+
+PBS is replaced by the in-memory bench/fake/pbs_ifl.py with --latency
+added to every PBS call. The database is an in-memory stand-in with
+the same per-owner locking (--db-latency per call), or a real
+PostgreSQL given by --dsn. Use a throwaway database only, its extended
+tables are emptied by the benchmark.
+
+Scenarios:
+ * single     - sequential extensions of one-node jobs
+ * concurrent - extensions by --threads threads of --users users
+ * bignode    - extensions of jobs running on --nodes nodes
+ * bigtable   - single extensions over --records existing records,
+                needs --dsn, skipped by --scenario all without it
+
+    bench/load.py [--scenario all] [--requests 1000] [--latency 1]
+    bench/load.py --dsn "host=localhost dbname=extender_bench user=bench"
+
+psycopg2 is needed with --dsn only.
+
+Latency percentiles and throughput are printed for each scenario.
+--save stores the results as JSON, --compare checks them against saved
+results and fails if p50 or p99 got worse by more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import importlib.util
+from configparser import ConfigParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENDER = os.path.join(os.path.dirname(BENCH_DIR),
+                        "openpbs-walltime-extender.py")
+
+sys.path.insert(0, os.path.join(BENCH_DIR, "fake"))
+import pbs_ifl
+import psycopg2_stub
+
+OWNER = "user%d@BENCH"
+CONFIG = """
+[general]
+clean_secs=2592000
+fund=.*@BENCH$:1000000000
+count=.*@BENCH$:1000000000
+admin_re=.*@ADMIN$
+
+[daemon]
+status_ttl=%(status_ttl)d
+"""
+
+
+def load_extender(args):
+    """
+    Loads the extender module with the benchmark config
+    """
+
+    if not args.dsn:
+        # the in-memory stand-in needs no PostgreSQL driver
+        psycopg2_stub.install()
+
+    spec = importlib.util.spec_from_file_location("extender", EXTENDER)
+    extender = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(extender)
+
+    parser = ConfigParser()
+    parser.read_string(CONFIG % {"status_ttl": args.status_ttl})
+    if args.dsn:
+        parser.add_section("postgresql")
+        for item in args.dsn.split():
+            key, value = item.split("=", 1)
+            parser.set("postgresql", key, value)
+
+    # no benchmark records in the production log
+    extender.logger = None
+
+    extender.reload_config()
+    extender.config_cache[extender.CONFIG_FILE] = parser
+    extender.status_cache.ttl = args.status_ttl
+
+    return extender
+
+
+class Memory_store(object):
+    """
+    Records and usage summary shared by Memory_database instances
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.owner_locks = {}
+        self.usage = {}
+
+    def owner_lock(self, owner):
+        with self.lock:
+            if owner not in self.owner_locks:
+                self.owner_locks[owner] = threading.Lock()
+            return self.owner_locks[owner]
+
+    def wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def add(self, owner, count, cputime, date):
+        with self.lock:
+            used = self.usage.get(owner, (0, 0, date))
+            self.usage[owner] = (used[0] + count, used[1] + cputime,
+                                 min(used[2], date))
+
+
+class Memory_database(object):
+    """
+    In-memory stand-in of Database with the methods used by
+    Walltime_extender, one instance per thread as from the pool
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.locked = None
+        self.pending = []
+
+    def connect(self):
+        return None
+
+    def disconnect(self):
+        self.rollback()
+
+    def is_connected(self):
+        return True
+
+    def reset(self):
+        self.rollback()
+
+    def query_usage(self, owner, seconds):
+        self.store.wait()
+        used = self.store.usage.get(owner)
+        if used is None:
+            return (0, 0, None)
+        return used
+
+    def get_usage(self, owner, seconds):
+        return self.query_usage(owner, seconds)
+
+    def lock_owner(self, owner, seconds):
+        self.store.owner_lock(owner).acquire()
+        self.locked = owner
+        return self.query_usage(owner, seconds)
+
+    def reserve_job(self, jobid, owner, cputime, charge=None):
+        self.store.wait()
+        self.pending.append((owner, cputime))
+        return True
+
+    def confirm_job(self):
+        pass
+
+    def release_job(self):
+        self.pending.pop()
+
+    def commit(self):
+        if len(self.pending) > 0:
+            self.store.wait()
+        for owner, cputime in self.pending:
+            self.store.add(owner, 1, cputime, time.time())
+        self.pending = []
+        self.unlock()
+
+    def rollback(self):
+        self.pending = []
+        self.unlock()
+
+    def unlock(self):
+        if self.locked is not None:
+            self.store.owner_lock(self.locked).release()
+            self.locked = None
+
+    def get_full_list(self, seconds, filters):
+        for owner, used in sorted(self.store.usage.items()):
+            yield (owner, used[0], used[1], used[2])
+
+    def clean_owner(self, owner):
+        self.store.usage.pop(owner, None)
+
+
+def open_databases(extender, args, count):
+    """
+    Opens a database per thread
+    """
+
+    if not args.dsn:
+        store = Memory_store(args.db_latency / 1000.0)
+        return [Memory_database(store) for i in range(count)]
+
+    dbs = []
+    for i in range(count):
+        db = extender.Database()
+        if db.connect():
+            raise Exception("Failed to connect to the database.")
+        dbs.append(db)
+
+    return dbs
+
+
+def prepare_database(extender, args, records):
+    """
+    Empties the tables of the throwaway database,
+    adds the records for the bigtable scenario
+    """
+
+    if not args.dsn:
+        return
+
+    db = extender.Database()
+    if db.connect() or db.check_schema():
+        raise Exception("Failed to initialize the database.")
+
+    cur = db.conn.cursor()
+    cur.execute("DELETE FROM extended;")
+    cur.execute("DELETE FROM extended_usage;")
+    if records > 0:
+        cur.execute("INSERT INTO extended (jobid, owner, cputime, date) \
+SELECT i || '.bench', 'user' || (i %% %d) || '@BENCH', 3600, \
+NOW() - (i %% 86400) * interval '1 second' \
+FROM generate_series(1, %d) AS i;" % (args.users, records))
+    cur.close()
+    db.conn.commit()
+    db.check_usage()
+    db.disconnect()
+
+
+def prepare_pbs(args, jobs, nodes_per_job):
+    """
+    Creates the jobs in the fake PBS, every job on its own nodes,
+    every tenth node with a reservation far in the future
+    """
+
+    pbs_ifl.reset()
+    pbs_ifl.LATENCY = args.latency / 1000.0
+    pbs_ifl.add_queue("workq", "1000:00:00")
+    pbs_ifl.add_resv("R1.%s" % pbs_ifl.SERVER_HOST, time.time() + 10 ** 7)
+
+    jobids = []
+    for i in range(jobs):
+        nodes = ["node%d_%d" % (i, n) for n in range(nodes_per_job)]
+        for n, node in enumerate(nodes):
+            resv = None
+            if n % 10 == 0:
+                resv = "R1.%s" % pbs_ifl.SERVER_HOST
+            pbs_ifl.add_node(node, resv=resv)
+
+        jobid = "%d.%s" % (i + 1, pbs_ifl.SERVER_HOST)
+        pbs_ifl.add_job(jobid, OWNER % (i % args.users), nodes, 8)
+        jobids.append(jobid)
+
+    return jobids
+
+
+def drive(extender, args, jobids, threads):
+    """
+    Extends every job once by threads threads,
+    returns (latencies, failures, elapsed seconds)
+    """
+
+    dbs = open_databases(extender, args, threads)
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    todo = list(jobids)
+
+    def worker(db):
+        conns = {}
+        extender.request_ctx.stdin = ""
+        while True:
+            with lock:
+                if len(todo) == 0:
+                    break
+                jobid = todo.pop()
+
+            owner = pbs_ifl.jobs[jobid]["Job_Owner"]
+            extender.request_ctx.env = {"REMOTE_USER": owner,
+                                        "REMOTE_ADDR": "bench"}
+            start = time.perf_counter()
+            ret = extender.run(["bench", jobid, "60"], db, conns)
+            secs = time.perf_counter() - start
+
+            with lock:
+                latencies.append(secs)
+                if ret != 0:
+                    failures[0] += 1
+
+        extender.close_servers(conns)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(db,))
+                   for db in dbs]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for db in dbs:
+        db.disconnect()
+
+    return latencies, failures[0], elapsed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def scenario(extender, args, name):
+    """
+    Runs the scenario, returns its results
+    """
+
+    threads = 1
+    nodes = 1
+    records = 0
+    requests = args.requests
+
+    if name == "concurrent":
+        threads = args.threads
+    elif name == "bignode":
+        nodes = args.nodes
+        requests = max(1, args.requests // 10)
+    elif name == "bigtable":
+        records = args.records
+
+    prepare_database(extender, args, records)
+    jobids = prepare_pbs(args, requests, nodes)
+    extender.status_cache.invalidate()
+
+    latencies, failures, elapsed = drive(extender, args, jobids, threads)
+
+    return {"requests": len(latencies),
+            "failures": failures,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+            "mean_ms": 1000 * sum(latencies) / max(1, len(latencies)),
+            "p50_ms": 1000 * percentile(latencies, 50),
+            "p99_ms": 1000 * percentile(latencies, 99),
+            "max_ms": 1000 * max(latencies or [0]),
+            "pbs_calls": dict(pbs_ifl.calls)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of regressions against the baseline
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ["p50_ms", "p99_ms"]:
+            old = baseline[name][key]
+            if old > 0 and result[key] > old * (1 + tolerance / 100.0):
+                regressions.append("%s %s: %.3f -> %.3f" %
+                                   (name, key, old, result[key]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test of the walltime extender")
+    parser.add_argument("--scenario", default="all",
+                        choices=["all", "single", "concurrent", "bignode",
+                                 "bigtable"])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="latency of a PBS call in ms")
+    parser.add_argument("--db-latency", type=float, default=0.0,
+                        help="latency of a stand-in database call in ms")
+    parser.add_argument("--status-ttl", type=int, default=30,
+                        help="status cache ttl, 0 queries PBS every request")
+    parser.add_argument("--dsn", help="throwaway PostgreSQL database")
+    parser.add_argument("--save", help="store the results as JSON")
+    parser.add_argument("--compare", help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=20.0,
+                        help="allowed p50/p99 regression in %%")
+    args = parser.parse_args()
+
+    names = ["single", "concurrent", "bignode", "bigtable"]
+    if args.scenario != "all":
+        names = [args.scenario]
+
+    # the in-memory stand-in keeps no records to grow
+    if not args.dsn and "bigtable" in names:
+        if args.scenario == "bigtable":
+            parser.error("the bigtable scenario needs --dsn")
+        print("Skipping bigtable without --dsn.", file=sys.stderr)
+        names.remove("bigtable")
+
+    extender = load_extender(args)
+
+    results = {}
+    print("%-12s %8s %8s %10s %10s %10s %10s %10s" %
+          ("scenario", "requests", "failed", "req/s", "mean [ms]",
+           "p50 [ms]", "p99 [ms]", "max [ms]"))
+    for name in names:
+        r = scenario(extender, args, name)
+        results[name] = r
+        print("%-12s %8d %8d %10.1f %10.3f %10.3f %10.3f %10.3f" %
+              (name, r["requests"], r["failures"], r["throughput"],
+               r["mean_ms"], r["p50_ms"], r["p99_ms"], r["max_ms"]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -3,4 +3,5 @@ sudo -u postgres /usr/lib/postgresql/15/bin/pg_ctl -D /tmp/pgsql_openpbs-walltim
 sudo -u postgres /usr/lib/postgresql/15/bin/pg_ctl -D /tmp/pgsql_openpbs-walltime-extender/ stop -w
 
 sudo -u postgres psql -h localhost -p 5455 -c 'CREATE DATABASE walltime_extender;'
+LD_LIBRARY_PATH=/opt/pbs/lib:/usr/lib /opt/pbs/bin/openpbs-walltime-extender.py --init-database
 
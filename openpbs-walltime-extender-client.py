@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import socket
+from configparser import ConfigParser
+
+CONFIG_FILE = "/opt/pbs/etc/openpbs-walltime-extender.conf"
+DAEMON_SOCKET = "/run/openpbs-walltime-extender/extender.sock"
+EXTENDER = "/opt/pbs/bin/openpbs-walltime-extender.py"
+
+
+def socket_path():
+    """
+    Gets the daemon socket from the config file
+    """
+
+    parser = ConfigParser()
+    parser.read(CONFIG_FILE)
+
+    if parser.has_option("daemon", "socket"):
+        return parser.get("daemon", "socket")
+
+    return DAEMON_SOCKET
+
+
+def run_extender():
+    """
+    The daemon is not running, serve the request directly
+    """
+
+    os.execv(EXTENDER, [EXTENDER] + sys.argv[1:])
+
+
+def main():
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path())
+    except OSError:
+        s.close()
+        run_extender()
+
+    req = {}
+    req["argv"] = sys.argv[1:]
+    req["env"] = {"REMOTE_USER": os.getenv("REMOTE_USER"),
+                  "REMOTE_ADDR": os.getenv("REMOTE_ADDR")}
+    if "-" in req["argv"]:
+        req["stdin"] = sys.stdin.read()
+
+    f = s.makefile("rwb")
+    f.write((json.dumps(req) + "\n").encode())
+    f.flush()
+
+    for line in f:
+        frame = json.loads(line.decode())
+
+        if "ret" in frame:
+            return frame["ret"]
+
+        if frame["fd"] == 2:
+            sys.stderr.write(frame["data"])
+        else:
+            sys.stdout.write(frame["data"])
+
+    print("Connection to the extender daemon lost.", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    exit(main())
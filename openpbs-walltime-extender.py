@@ -3,9 +3,20 @@
 import re
 import sys
 import os
-import subprocess
 import logging
+import logging.handlers
+import atexit
 import json
+import time
+import queue
+import signal
+import socket
+import struct
+import threading
+import socketserver
+import functools
+import bisect
+import http.server
 from datetime import datetime
 from configparser import ConfigParser
 
@@ -22,11 +33,22 @@ except:
     import psycopg2
 
 
-def config(filename="/opt/pbs/etc/openpbs-walltime-extender.conf",
-           section=""):
+CONFIG_FILE = "/opt/pbs/etc/openpbs-walltime-extender.conf"
+config_cache = {}
 
-    parser = ConfigParser()
-    parser.read(filename)
+
+def config(filename=CONFIG_FILE, section=""):
+    """
+    Returns the section of the config file as dict.
+    The file is parsed only once per process (see reload_config()).
+    """
+
+    if filename not in config_cache:
+        parser = ConfigParser()
+        parser.read(filename)
+        config_cache[filename] = parser
+
+    parser = config_cache[filename]
 
     c = {}
     if parser.has_section(section):
@@ -40,59 +62,166 @@ def config(filename="/opt/pbs/etc/openpbs-walltime-extender.conf",
     return c
 
 
+def reload_config():
+    """
+    Forgets the parsed config, next config() call reads the file again
+    """
+
+    config_cache.clear()
+    rules_cache.clear()
+    node_policy_cache.clear()
+    charging_cache.clear()
+    status_cache.invalidate()
+    server_hosts.clear()
+
+
+# per-thread request context, used by the daemon to pass
+# the remote environment and the output stream of the served request
+request_ctx = threading.local()
+
+
+def request_stdin():
+    """
+    Reads stdin of the current request
+    """
+
+    data = getattr(request_ctx, "stdin", None)
+    if data is not None:
+        return data
+
+    return sys.stdin.read()
+
+
+def remote_env(name):
+    """
+    Gets REMOTE_USER/REMOTE_ADDR of the current request
+    """
+
+    env = getattr(request_ctx, "env", None)
+    if env is not None:
+        return env.get(name)
+
+    return os.getenv(name)
+
+
 TOOL_NAME = "openpbs-walltime-extender"
+DAEMON_SOCKET = "/run/openpbs-walltime-extender/extender.sock"
 FORMAT = "%(asctime)-15s %(ip)s %(user)-8s %(levelname)s %(message)s"
 INFO = 0
 WARNING = 1
 ERROR = 2
 DEBUG = 3
-try:
-    logfile = config(section="logging")["logfile"]
-except:
-    logfile = None
-logging.basicConfig(filename=logfile,
-                    format=FORMAT,
-                    level=logging.DEBUG)
-logger = logging.getLogger(TOOL_NAME)
+SYSLOG_FORMAT = "meta-utils[%(process)d]: %(user)s-%(ip)s " + __file__ + \
+    " %(message)s"
+SYSLOG_SOCKET = "/dev/log"
+LOG_LEVELS = {INFO: logging.INFO, WARNING: logging.WARNING,
+              ERROR: logging.ERROR, DEBUG: logging.DEBUG}
+
+
+def setup_logging():
+    """
+    Sets up the logger. The records are passed through a queue
+    to a background thread writing them to the logfile and/or syslog
+    (journald), so logMsg() never blocks nor forks.
+
+    [logging] backend - file, syslog or both (default)
+    """
+
+    cfg = {}
+    try:
+        cfg = config(section="logging")
+    except:
+        pass
+
+    logfile = cfg.get("logfile")
+    backend = cfg.get("backend", "both")
+
+    handlers = []
+
+    if logfile and backend in ["file", "both"]:
+        handler = logging.FileHandler(logfile)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        handlers.append(handler)
+
+    # the handler does not fail without the socket, only every record
+    if backend in ["syslog", "both"] and os.path.exists(SYSLOG_SOCKET):
+        try:
+            handler = logging.handlers.SysLogHandler(
+                address=SYSLOG_SOCKET,
+                facility=logging.handlers.SysLogHandler.LOG_USER)
+            handler.setLevel(logging.INFO)
+            handler.setFormatter(logging.Formatter(SYSLOG_FORMAT))
+            handlers.append(handler)
+        except OSError:
+            # no syslog daemon
+            pass
+
+    log = logging.getLogger(TOOL_NAME)
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+
+    if len(handlers) == 0:
+        return None
+
+    log_queue = queue.Queue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return log
 
 
-def logMsg(lvl, msg):
-    if lvl > INFO and lvl < DEBUG:
+logger = setup_logging()
+
+
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+WHITESPACE = re.compile(r'\s+')
+LEVEL_NAMES = {INFO: "info", WARNING: "warning", ERROR: "error",
+               DEBUG: "debug"}
+
+
+def show_msg(msg="", lvl=INFO):
+    """
+    Shows the message to the user. In the JSON mode (--json)
+    the message is kept for the JSON output instead.
+    """
+
+    messages = getattr(request_ctx, "messages", None)
+    if messages is not None:
+        messages.append({"level": LEVEL_NAMES[lvl],
+                         "message": ANSI_ESCAPE.sub('', msg)})
+    elif lvl > INFO and lvl < DEBUG:
         print(msg, file=sys.stderr)
     else:
         print(msg)
 
-    if not logfile:
-        return
 
-    msg = msg.replace('\n', ' ')
-    msg = msg.replace('\t', ' ')
-    msg = re.sub(' +', ' ', msg)
+def logMsg(lvl, msg, echo=True):
+    if lvl == ERROR and hasattr(request_ctx, "errors"):
+        request_ctx.errors += 1
+
+    if echo:
+        show_msg(msg, lvl)
+
+    if logger is None:
+        return
 
-    # remove text colorization
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    msg = ansi_escape.sub('', msg)
+    # one line without text colorization
+    msg = WHITESPACE.sub(' ', ANSI_ESCAPE.sub('', msg))
 
-    user = os.getenv("REMOTE_USER")
+    user = remote_env("REMOTE_USER")
     if user is None or len(user) == 0:
         user = "unknown-user"
 
-    ip = os.getenv("REMOTE_ADDR")
+    ip = remote_env("REMOTE_ADDR")
     if ip is None or len(ip) == 0:
         ip = "unknown-ip"
 
-    if lvl == INFO:
-        subprocess.Popen(f"logger -p user.info -t meta-utils --id=${os.getpid()} -- {user}-{ip} {__file__} \"{msg}\" 2>/dev/null", shell=True)
-
     d = {'ip': ip, 'user': user}
-    if lvl == INFO:
-        logger.info(msg, extra=d)
-    if lvl == WARNING:
-        logger.warning(msg, extra=d)
-    if lvl == ERROR:
-        logger.error(msg, extra=d)
-    if lvl == DEBUG:
-        logger.debug(msg, extra=d)
+    logger.log(LOG_LEVELS[lvl], msg, extra=d)
 
 
 class bcolors:
@@ -107,10 +236,528 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+def human2sec(h):
+    """
+    Converts hh:mm:ss to seconds
+    """
+
+    a = h.split(":")
+
+    s = 0
+
+    if len(a) > 0:
+        s += int(a[len(a) - 1])
+    if len(a) > 1:
+        s += int(a[len(a) - 2]) * 60
+    if len(a) > 2:
+        s += int(a[len(a) - 3]) * 60 * 60
+
+    return s
+
+
+def sec2human(s):
+    """
+    Converts seconds to hh:mm:ss
+    """
+
+    h = ""
+
+    hours = int(s / 60 / 60)
+    s = s % (60 * 60)
+
+    mins = int(s / 60)
+    s = s % 60
+
+    secs = int(s)
+
+    h = "%02d:%02d:%02d" % (hours, mins, secs)
+    return h
+
+
+class Metrics(object):
+    """
+    Request counters and latency histograms in the Prometheus
+    text format. Exported by the daemon (see Metrics_exporter).
+    """
+
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, secs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self.BUCKETS), 0.0, 0]
+                self.histograms[key] = histogram
+
+            for i, bound in enumerate(self.BUCKETS):
+                if secs <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += secs
+            histogram[2] += 1
+
+    def timer(self, phase):
+        """
+        Context manager measuring the time of the phase
+        """
+
+        return Phase_timer(self, phase)
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text format
+        """
+
+        def fmt(labels):
+            return ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                            for k, v in labels)
+
+        lines = []
+        with self.lock:
+            names = sorted(set(key[0] for key in self.counters))
+            for name in names:
+                lines.append("# TYPE %s counter" % name)
+                for key, value in sorted(self.counters.items()):
+                    if key[0] == name:
+                        lines.append("%s{%s} %d" % (name, fmt(key[1]), value))
+
+            names = sorted(set(key[0] for key in self.histograms))
+            for name in names:
+                lines.append("# TYPE %s histogram" % name)
+                for key, histogram in sorted(self.histograms.items()):
+                    if key[0] != name:
+                        continue
+                    buckets, total, count = histogram
+                    labels = fmt(key[1])
+                    for bound, n in zip(self.BUCKETS, buckets):
+                        lines.append('%s_bucket{%s,le="%s"} %d' %
+                                     (name, labels, bound, n))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                                 (name, labels, count))
+                    lines.append("%s_sum{%s} %f" % (name, labels, total))
+                    lines.append("%s_count{%s} %d" % (name, labels, count))
+
+        return "\n".join(lines) + "\n"
+
+
+class Phase_timer(object):
+    """
+    Observes the time spent in a with block as
+    walltime_extender_phase_seconds{phase=...}
+    """
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe("walltime_extender_phase_seconds",
+                             {"phase": self.phase},
+                             time.perf_counter() - self.start)
+        return False
+
+
+metrics = Metrics()
+
+
+def timed(phase):
+    """
+    Decorator measuring the time of each call as the phase
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# flags of a pattern without inline flags
+DEFAULT_RE_FLAGS = re.compile("").flags
+
+
+class Rule_list(object):
+    """
+    Ordered list of 'regex:value' rules, the first matching rule wins.
+    The rules are compiled once into a single alternation
+    with a named group per rule.
+    """
+
+    def __init__(self, name, preparsed, convert):
+        self.preparsed = preparsed
+        self.rules = []
+
+        for r in preparsed.split(","):
+            r = r.strip()
+            if len(r) == 0:
+                continue
+
+            rule = r.rsplit(":", 1)
+            if len(rule) != 2:
+                raise Exception("Invalid %s rule '%s'." % (name, r))
+
+            [rule_re, rule_value] = rule
+            try:
+                rule_re = re.compile(rule_re.strip())
+                rule_value = convert(rule_value.strip())
+            except (re.error, ValueError) as e:
+                raise Exception("Invalid %s rule '%s': %s." % (name, r, e))
+
+            self.rules.append((rule_re, rule_value))
+
+        # inline flags like '(?i)' apply to the whole merged pattern
+        # (only deprecated before Python 3.11), such rules are
+        # matched one by one, as the rules with groups
+        self.merged = None
+        if len(self.rules) > 0 and \
+           all(rule_re.groups == 0 and rule_re.flags == DEFAULT_RE_FLAGS
+               for rule_re, rule_value in self.rules):
+            try:
+                self.merged = re.compile("|".join(
+                    "(?P<r%d>%s)" % (i, rule_re.pattern)
+                    for i, (rule_re, rule_value) in enumerate(self.rules)))
+            except re.error:
+                self.merged = None
+
+    def lookup(self, owner, default):
+        """
+        Returns the value of the first rule matching owner
+        """
+
+        if self.merged is not None:
+            match = self.merged.match(owner)
+            if match:
+                return self.rules[int(match.lastgroup[1:])][1]
+            return default
+
+        for rule_re, rule_value in self.rules:
+            if rule_re.match(owner):
+                return rule_value
+
+        return default
+
+
+class Rules(object):
+    """
+    Parsed and validated [general] section
+    """
+
+    def __init__(self, cfg):
+        self.clean_secs = 2592000
+        self.default_fund = 10368000
+        self.default_count = 20
+
+        try:
+            if "clean_secs" in cfg.keys():
+                self.clean_secs = human2sec(cfg["clean_secs"])
+        except ValueError:
+            raise Exception("Invalid clean_secs '%s'." % cfg["clean_secs"])
+
+        self.fund_rules = Rule_list("fund", cfg.get("fund", ""), int)
+        self.count_rules = Rule_list("count", cfg.get("count", ""), int)
+
+        self.owner_re = self.compile(
+            cfg, "owner_re", r'^[a-z][a-z0-9_-]{1,14}@[A-Z0-9\._-]+$')
+        self.admin_re = self.compile(cfg, "admin_re", r'NOTHING')
+        self.list_re = self.compile(cfg, "list_re", r'.*')
+
+    def compile(self, cfg, name, default):
+        """
+        Compiles regex option, returns None for an empty one
+        """
+
+        pattern = cfg.get(name, default)
+        if len(pattern) == 0:
+            return None
+
+        try:
+            return re.compile(pattern)
+        except re.error as e:
+            raise Exception("Invalid %s '%s': %s." % (name, pattern, e))
+
+    def fund(self, owner):
+        return self.fund_rules.lookup(owner, self.default_fund)
+
+    def count(self, owner):
+        return self.count_rules.lookup(owner, self.default_count)
+
+    def valid_owner(self, owner):
+        return self.owner_re is None or \
+            self.owner_re.match(owner) is not None
+
+    def is_admin(self, owner):
+        return self.admin_re is not None and \
+            self.admin_re.match(owner) is not None
+
+    def listing_enabled(self):
+        return self.list_re is not None
+
+    def may_list(self, owner):
+        return self.list_re is not None and \
+            self.list_re.match(owner) is not None
+
+
+rules_cache = []
+
+
+def get_rules():
+    """
+    Returns Rules of the config file, parsed only once per process
+    """
+
+    if len(rules_cache) == 0:
+        rules_cache.append(Rules(config(section="general")))
+
+    return rules_cache[0]
+
+
+DEDICATED_TIME_FORMAT = "%m/%d/%Y %H:%M"
+
+
+class Node_policy(object):
+    """
+    Parsed [nodes] section, the node queues, states and resources
+    blocking the extension of the jobs running on the node
+    and the PBS dedicated time windows
+    """
+
+    def __init__(self, cfg):
+        self.queues = self.split(cfg.get("blocking_queues",
+                                         "maintenance,reserved"))
+        self.states = self.split(cfg.get("blocking_states", ""))
+
+        # [(attribute, value), ...]
+        self.resources = []
+        for item in self.split(cfg.get("blocking_resources", "")):
+            if "=" not in item:
+                raise Exception("Invalid blocking_resources '%s'." % item)
+            name, value = item.split("=", 1)
+            self.resources.append((name.strip(), value.strip()))
+
+        self.dedicated_file = cfg.get("dedicated_time") or None
+        self.dedicated = []
+        self.dedicated_mtime = None
+        self.lock = threading.Lock()
+
+        # the node attributes the policy needs, stated at once
+        self.attrs = ["queue"]
+        if len(self.states) > 0:
+            self.attrs.append("state")
+        for name, value in self.resources:
+            if name not in self.attrs:
+                self.attrs.append(name)
+
+    def split(self, value):
+        return [item.strip() for item in value.split(",")
+                if len(item.strip()) > 0]
+
+    def blocking(self, node_info):
+        """
+        Returns why the node blocks the extension, None if it does not
+        """
+
+        queue = node_info.get("queue")
+        if queue in self.queues:
+            return "queue %s" % queue
+
+        if len(self.states) > 0:
+            for state in node_info.get("state", "").split(","):
+                if state.strip() in self.states:
+                    return "state %s" % state.strip()
+
+        for name, value in self.resources:
+            if node_info.get(name) == value:
+                return "%s=%s" % (name, value)
+
+        return None
+
+    def dedicated_windows(self):
+        """
+        Returns sorted [(start, end), ...] of the dedicated time file,
+        the file is read again when it changes
+        """
+
+        if self.dedicated_file is None:
+            return []
+
+        try:
+            mtime = os.stat(self.dedicated_file).st_mtime
+        except OSError:
+            # no dedicated time defined
+            return []
+
+        with self.lock:
+            if mtime != self.dedicated_mtime:
+                self.dedicated = self.read_dedicated()
+                self.dedicated_mtime = mtime
+
+            return self.dedicated
+
+    def read_dedicated(self):
+        """
+        Parses the dedicated time file of the scheduler,
+        lines 'MM/DD/YYYY HH:MM MM/DD/YYYY HH:MM', # comments
+        """
+
+        windows = []
+        try:
+            with open(self.dedicated_file) as f:
+                for line in f:
+                    a = line.split("#")[0].split()
+                    if len(a) == 0:
+                        continue
+
+                    try:
+                        if len(a) != 4:
+                            raise ValueError
+                        start = datetime.strptime(" ".join(a[0:2]),
+                                                  DEDICATED_TIME_FORMAT)
+                        end = datetime.strptime(" ".join(a[2:4]),
+                                                DEDICATED_TIME_FORMAT)
+                    except ValueError:
+                        logMsg(WARNING, "Invalid dedicated time '%s'." %
+                               line.strip(), echo=False)
+                        continue
+
+                    windows.append((start.timestamp(), end.timestamp()))
+        except OSError as e:
+            logMsg(ERROR, "Failed to read %s: %s." %
+                   (self.dedicated_file, e), echo=False)
+
+        return sorted(windows)
+
+    def dedicated_start(self, since):
+        """
+        Returns the start of the first dedicated time window
+        starting after since, None if there is none
+        """
+
+        windows = self.dedicated_windows()
+        i = bisect.bisect_right(windows, (since, float("inf")))
+        if i < len(windows):
+            return windows[i][0]
+
+        return None
+
+
+node_policy_cache = []
+
+
+def get_node_policy():
+    """
+    Returns Node_policy of the config file, parsed only once per process
+    """
+
+    if len(node_policy_cache) == 0:
+        try:
+            cfg = config(section="nodes")
+        except:
+            cfg = {}
+        node_policy_cache.append(Node_policy(cfg))
+
+    return node_policy_cache[0]
+
+
+class Charging(object):
+    """
+    Parsed [charging] section, the cputime charged per second
+    of the extension for the resources of the job
+    """
+
+    def __init__(self, cfg):
+        self.preparsed = cfg.get("weights", "ncpus:1")
+
+        # [(resource, weight per unit), ...]
+        self.weights = []
+        for item in self.preparsed.split(","):
+            item = item.strip()
+            if len(item) == 0:
+                continue
+
+            try:
+                name, weight = item.rsplit(":", 1)
+                weight, sep, unit = weight.partition("/")
+                weight = float(weight)
+                if len(unit) > 0:
+                    # weight per unit of a size resource, the sizes
+                    # are summed in bytes
+                    weight /= SIZE_UNITS[unit.strip().lower()]
+            except (ValueError, KeyError):
+                raise Exception("Invalid charging weight '%s'." % item)
+
+            self.weights.append((name.strip(), weight))
+
+        self.queues = Rule_list("queues", cfg.get("queues", ""), float)
+
+    def rate(self, exec_vnode, queue):
+        """
+        Returns (cputime charged per second of the extension,
+        dict of the charged resources and the queue multiplier)
+        """
+
+        rate = 0.0
+        resources = {}
+        for name, weight in self.weights:
+            # a chunk without ncpus counts as one cpu, see get_ncpus()
+            total = exec_vnode.total(name, 1 if name == "ncpus" else 0)
+            resources[name] = total
+            rate += weight * total
+
+        multiplier = self.queues.lookup(queue, 1.0)
+
+        return (rate * multiplier,
+                {"resources": resources, "multiplier": multiplier})
+
+
+charging_cache = []
+
+
+def get_charging():
+    """
+    Returns Charging of the config file, parsed only once per process
+    """
+
+    if len(charging_cache) == 0:
+        try:
+            cfg = config(section="charging")
+        except:
+            cfg = {}
+        charging_cache.append(Charging(cfg))
+
+    return charging_cache[0]
+
+
+STATEMENT_PARAM = re.compile(r'\$([0-9]+)')
+PARTITION_BOUND = re.compile(
+    r"FOR VALUES FROM \('([^']*)'\) TO \('([^']*)'\)")
+PARTITION_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
 class Database(object):
     """
     """
 
+    SCHEMA_LOCK = 0x77657874
+    OWNER_LOCK = 0x77657875
+    PARTITIONS_AHEAD = 2
+
     def __init__(self):
         """
         Init
@@ -119,9 +766,30 @@ class Database(object):
         self.table_name = "extended"
         self.conn = None
         self.connected = False
+        self.prepared = set()
         self.params = config(section="postgresql")
 
+        # 0 - not partitioned
+        self.partition_secs = 0
+        # connected through PgBouncer in transaction pooling mode,
+        # no session state (prepared statements) can be kept
+        self.pgbouncer = False
+        try:
+            cfg = config(section="database")
+        except:
+            cfg = {}
+        if "partition_secs" in cfg.keys():
+            self.partition_secs = human2sec(cfg["partition_secs"])
+        if "pgbouncer" in cfg.keys():
+            self.pgbouncer = cfg["pgbouncer"].lower() in \
+                ("1", "yes", "true", "on")
+
+    @timed("db_connect")
     def connect(self):
+        """
+        Connects to the database,
+        the schema is created by init_database()
+        """
 
         try:
             self.conn = psycopg2.connect(**self.params)
@@ -131,206 +799,1010 @@ class Database(object):
 
         self.connected = True
 
-        if self.check_table(self.table_name):
-            self.connected = False
-            return
-
     def disconnect(self):
         if self.conn is not None:
             self.conn.close()
         self.connected = False
+        self.prepared.clear()
 
     def is_connected(self):
         return self.connected
 
-    def check_table(self, table_name):
+    def reset(self):
+        """
+        Prepares a kept connection for the next request.
+        Reconnects if the connection has been lost.
+        """
+
+        if self.connected and not self.conn.closed:
+            try:
+                self.conn.rollback()
+                return
+            except:
+                logMsg(WARNING, "Database connection lost, reconnecting.")
+
+        self.disconnect()
+        self.connect()
+
+    # schema versions, every migration upgrades from the previous one
+    MIGRATIONS = [
+        # 1: the original layout
+        (1, ["CREATE TABLE IF NOT EXISTS %(table)s (\
+jobid varchar(511), \
+owner varchar(255), \
+cputime integer, \
+date timestamp);"]),
+        # 2: owner lookups and expiry without sequential scans
+        (2, ["CREATE INDEX IF NOT EXISTS %(table)s_owner_date_idx \
+ON %(table)s (owner, date);",
+             "CREATE INDEX IF NOT EXISTS %(table)s_date_idx \
+ON %(table)s (date);"]),
+        # 3: per-owner usage summary
+        (3, ["CREATE TABLE IF NOT EXISTS %(table)s_usage (\
+owner varchar(255) PRIMARY KEY, \
+count integer, \
+cputime bigint, \
+earliest timestamp);",
+             "INSERT INTO %(table)s_usage (owner, count, cputime, earliest) \
+SELECT owner, COUNT(cputime), SUM(cputime), MIN(date) FROM %(table)s \
+GROUP BY owner ON CONFLICT (owner) DO NOTHING;"]),
+        # 4: the resources and multiplier the record was charged for
+        (4, ["ALTER TABLE %(table)s ADD COLUMN IF NOT EXISTS charge jsonb;"]),
+    ]
+
+    # statements prepared once per connection,
+    # name: (parameter types, query)
+    STATEMENTS = {
+        "insert_job": ("varchar, varchar, integer, jsonb",
+                       "INSERT INTO %(table)s \
+(jobid, owner, cputime, date, charge) VALUES ($1, $2, $3, NOW(), $4)"),
+        "add_usage": ("varchar, integer",
+                      "INSERT INTO %(table)s_usage \
+(owner, count, cputime, earliest) VALUES ($1, 1, $2, NOW()) \
+ON CONFLICT (owner) DO UPDATE SET \
+count = %(table)s_usage.count + 1, \
+cputime = %(table)s_usage.cputime + EXCLUDED.cputime, \
+earliest = LEAST(%(table)s_usage.earliest, EXCLUDED.earliest)"),
+        "lock_owner": ("varchar",
+                       "SELECT pg_advisory_xact_lock(%(owner_lock)d, \
+hashtext($1))"),
+        "get_usage": ("varchar, integer",
+                      "SELECT count, cputime, \
+earliest + $2 * interval '1 second', \
+earliest > NOW() - $2 * interval '1 second' \
+FROM %(table)s_usage WHERE owner = $1"),
+        "count_usage": ("varchar, integer",
+                        "SELECT COUNT(cputime), COALESCE(SUM(cputime), 0), \
+MIN(date) + $2 * interval '1 second' FROM %(table)s \
+WHERE owner = $1 AND date > NOW() - $2 * interval '1 second'"),
+        "get_full_list": ("integer, varchar, varchar, bigint, bigint, \
+bigint, bigint",
+                          "SELECT owner, count, cputime, timeout FROM \
+(SELECT owner, count, cputime, \
+earliest + $1 * interval '1 second' AS timeout FROM %(table)s_usage \
+WHERE earliest > NOW() - $1 * interval '1 second' \
+UNION ALL \
+SELECT owner, COUNT(cputime) AS count, SUM (cputime) AS total_cputime, \
+MIN(date) + $1 * interval '1 second' FROM %(table)s \
+WHERE date > NOW() - $1 * interval '1 second' AND owner IN \
+(SELECT owner FROM %(table)s_usage \
+WHERE earliest <= NOW() - $1 * interval '1 second') \
+GROUP BY owner) AS usage \
+WHERE ($2::varchar IS NULL OR owner ~ $2) \
+AND ($3::varchar IS NULL OR split_part(owner, '@', 2) = $3) \
+AND cputime >= COALESCE($4, 0) AND count >= COALESCE($5, 0) \
+ORDER BY owner LIMIT $6 OFFSET $7"),
+        "clean_owner": ("varchar",
+                        "DELETE FROM %(table)s WHERE owner = $1"),
+        "clean_owner_usage": ("varchar",
+                              "DELETE FROM %(table)s_usage WHERE owner = $1"),
+    }
+
+    def execute(self, cur, name, params):
+        """
+        Executes the prepared statement name with bound params,
+        the statement is prepared on its first use on the connection.
+        Behind PgBouncer, or for a server-side cursor which declares
+        the query itself, the statement is sent with the params instead.
+        """
+
+        if self.pgbouncer or cur.name is not None:
+            types, sql = self.STATEMENTS[name]
+            sql = sql % self.statement_names()
+            cur.execute(STATEMENT_PARAM.sub(r'%(p\1)s', sql),
+                        dict(("p%d" % (i + 1), param)
+                             for i, param in enumerate(params)))
+            return
+
+        if name not in self.prepared:
+            types, sql = self.STATEMENTS[name]
+            cur.execute("PREPARE %s (%s) AS %s;" %
+                        (name, types, sql % self.statement_names()))
+            self.prepared.add(name)
+
+        cur.execute("EXECUTE %s (%s);" %
+                    (name, ", ".join(["%s"] * len(params))), params)
+
+    def statement_names(self):
+        return {"table": self.table_name, "owner_lock": self.OWNER_LOCK}
+
+    def schema_version(self):
+        """
+        Gets the schema version, 0 for a database without version
+        """
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT MAX(version) FROM %s_schema;"
+                        % self.table_name)
+            version = cur.fetchone()[0]
+            cur.close()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            return 0
+
+        if version is None:
+            return 0
+
+        return version
+
+    def check_schema(self):
+        """
+        Creates or migrates the schema to the last version,
+        converts the table to a partitioned one if configured
+        """
+
+        if not self.is_connected():
+            return 1
+
+        last_version = self.MIGRATIONS[-1][0]
+
+        if self.schema_version() < last_version:
+            try:
+                cur = self.conn.cursor()
+                # concurrent extenders wait for the first one
+                cur.execute("SELECT pg_advisory_xact_lock(%d);"
+                            % self.SCHEMA_LOCK)
+                cur.execute("CREATE TABLE IF NOT EXISTS %s_schema \
+(version integer, date timestamp);" % self.table_name)
+                cur.execute("SELECT MAX(version) FROM %s_schema;"
+                            % self.table_name)
+                version = cur.fetchone()[0] or 0
+
+                for migration_version, sqls in self.MIGRATIONS:
+                    if migration_version <= version:
+                        continue
+                    for sql in sqls:
+                        cur.execute(sql % {"table": self.table_name})
+                    cur.execute("INSERT INTO %s_schema (version, date) \
+VALUES (%d, NOW());" % (self.table_name, migration_version))
+
+                cur.close()
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logMsg(ERROR, "Failed to migrate the schema: %s" % e)
+                return 1
+
+        if self.partition_secs > 0 and not self.is_partitioned():
+            if self.partition_table():
+                return 1
+
+        return 0
+
+    def is_partitioned(self):
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT relkind FROM pg_class \
+WHERE relname = %s;", (self.table_name,))
+            relkind = cur.fetchone()[0]
+            cur.close()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            return False
+
+        return relkind == "p"
+
+    def partition_table(self):
+        """
+        Converts the table to a table partitioned by date.
+        The existing records are moved to the default partition
+        and spread by ensure_partitions().
+        """
+
+        table = self.table_name
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT pg_advisory_xact_lock(%d);"
+                        % self.SCHEMA_LOCK)
+            cur.execute("SELECT relkind FROM pg_class \
+WHERE relname = %s;", (table,))
+            if cur.fetchone()[0] != "p":
+                cur.execute("ALTER TABLE %s RENAME TO %s_unpartitioned;"
+                            % (table, table))
+                cur.execute("DROP INDEX IF EXISTS %s_owner_date_idx, \
+%s_date_idx;" % (table, table))
+                cur.execute("CREATE TABLE %s (\
+jobid varchar(511), \
+owner varchar(255), \
+cputime integer, \
+date timestamp, \
+charge jsonb) PARTITION BY RANGE (date);" % table)
+                cur.execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT;"
+                            % (table, table))
+                cur.execute("CREATE INDEX %s_owner_date_idx \
+ON %s (owner, date);" % (table, table))
+                cur.execute("CREATE INDEX %s_date_idx ON %s (date);"
+                            % (table, table))
+                cur.execute("INSERT INTO %s \
+(jobid, owner, cputime, date, charge) \
+SELECT jobid, owner, cputime, date, charge FROM %s_unpartitioned;"
+                            % (table, table))
+                cur.execute("DROP TABLE %s_unpartitioned;" % table)
+            cur.close()
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to partition the table: %s" % e)
+            return 1
+
+        logMsg(INFO, "Table %s has been partitioned." % table, echo=False)
+
+        return 0
+
+    def get_partitions(self):
+        """
+        Gets [(name, from, to), ...] of the range partitions
+        """
+
+        partitions = []
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT c.relname, \
+pg_get_expr(c.relpartbound, c.oid) \
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid \
+WHERE i.inhparent = %s::regclass;", (self.table_name,))
+            rows = cur.fetchall()
+            cur.close()
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to get partitions.")
+            return None
+
+        for name, bound in rows:
+            match = PARTITION_BOUND.match(bound)
+            if match:
+                lo = datetime.strptime(match.group(1), PARTITION_TIME_FORMAT)
+                hi = datetime.strptime(match.group(2), PARTITION_TIME_FORMAT)
+                partitions.append((name, lo, hi))
+
+        return partitions
+
+    def ensure_partitions(self, seconds):
+        """
+        Creates partitions for the last clean period
+        and PARTITIONS_AHEAD periods ahead
+        """
+
+        partitions = self.get_partitions()
+        if partitions is None:
+            return
+
+        period = self.partition_secs
+        now = datetime.now().timestamp()
+        first = int((now - seconds) // period)
+        last = int(now // period) + self.PARTITIONS_AHEAD
+
+        table = self.table_name
+
+        for i in range(first, last + 1):
+            lo = datetime.fromtimestamp(i * period)
+            hi = datetime.fromtimestamp((i + 1) * period)
+
+            overlaps = False
+            for name, p_lo, p_hi in partitions:
+                if p_lo < hi and lo < p_hi:
+                    overlaps = True
+            if overlaps:
+                continue
+
+            name = "%s_p%s" % (table, lo.strftime("%Y%m%d%H%M%S"))
+            try:
+                cur = self.conn.cursor()
+                # records of the range may be in the default partition
+                cur.execute("CREATE TEMPORARY TABLE moved ON COMMIT DROP AS \
+SELECT * FROM " + table + "_default WHERE date >= %s AND date < %s;",
+                            (lo, hi))
+                cur.execute("DELETE FROM " + table + "_default \
+WHERE date >= %s AND date < %s;", (lo, hi))
+                cur.execute("CREATE TABLE %s PARTITION OF %s \
+FOR VALUES FROM ('%s') TO ('%s');" % (name, table, lo, hi))
+                cur.execute("INSERT INTO %s SELECT * FROM moved;" % table)
+                cur.close()
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logMsg(ERROR, "Failed to create partition %s: %s" % (name, e))
+                return
+
+    def drop_old_partitions(self, seconds):
+        """
+        Drops partitions with all records older than seconds
+        """
+
+        partitions = self.get_partitions()
+        if partitions is None:
+            return
+
+        limit = datetime.fromtimestamp(datetime.now().timestamp() - seconds)
+
+        for name, lo, hi in partitions:
+            if hi > limit:
+                continue
+
+            try:
+                cur = self.conn.cursor()
+                cur.execute("DROP TABLE %s;" % name)
+                cur.close()
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                logMsg(ERROR, "Failed to drop partition %s." % name)
+
+    @timed("db_lock_owner")
+    def lock_owner(self, owner, seconds):
+        """
+        Starts the fund reservation of the owner. Locks the owner
+        until commit() or rollback(), so concurrent extensions of the owner
+        wait, other owners are not affected.
+        Returns the usage as get_usage(), (-1, -1, None) on failure.
+        """
+
         if not self.is_connected():
-            return 1
-
-        sql = "CREATE TABLE IF NOT EXISTS %s (\
-jobid varchar(511), \
-owner varchar(255), \
-cputime integer, \
-date timestamp);" % table_name
+            return (-1, -1, None)
 
         try:
             cur = self.conn.cursor()
-            cur.execute(sql)
+            self.execute(cur, "lock_owner", (owner,))
+            usage = self.query_usage(cur, owner, seconds)
             cur.close()
-            self.conn.commit()
         except:
-            logMsg(ERROR, "Failed to check or create table.")
-            return 1
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to lock used fund and count.")
+            return (-1, -1, None)
 
-        return 0
+        return usage
 
-    def insert_job(self, jobid, owner, cputime):
-        if not self.is_connected():
-            return
+    @timed("db_reserve_job")
+    def reserve_job(self, jobid, owner, cputime, charge=None):
+        """
+        Records the job in the open reservation,
+        kept by confirm_job() or removed by release_job().
+        charge - dict of the charged resources kept with the record.
+        Returns False on failure.
+        """
 
-        jobid = self.sanitize(jobid)
-        owner = self.sanitize(owner)
-        cputime = self.sanitize(cputime)
+        if charge is not None:
+            charge = json.dumps(charge)
 
-        sql = "INSERT INTO %s (jobid, owner, cputime, date) \
-VALUES ('%s', '%s', %d, NOW());" % (self.table_name, jobid, owner, cputime)
+        if not self.is_connected():
+            return False
 
+        cur = self.conn.cursor()
         try:
-            cur = self.conn.cursor()
-            cur.execute(sql)
+            cur.execute("SAVEPOINT reservation;")
+            self.execute(cur, "insert_job", (jobid, owner, cputime, charge))
+            self.execute(cur, "add_usage", (owner, cputime))
             cur.close()
-            self.conn.commit()
         except:
-            logMsg(ERROR, "Failed to insert a job into database.")
-
-    def get_used_fund(self, owner):
-        if not self.is_connected():
-            return -1
-
-        owner = self.sanitize(owner)
+            logMsg(ERROR, "Failed to reserve fund for %s." % jobid)
+            self.release_job()
+            return False
 
-        used_fund = -1
+        return True
 
-        sql = "SELECT SUM (cputime) AS total_cputime FROM %s \
-WHERE owner = '%s';" % (self.table_name, owner)
+    @timed("db_confirm_job")
+    def confirm_job(self):
+        """
+        Keeps the last reserved job in the reservation
+        """
 
         try:
             cur = self.conn.cursor()
-            cur.execute(sql)
-            used_fund = cur.fetchone()[0]
+            cur.execute("RELEASE SAVEPOINT reservation;")
             cur.close()
-            self.conn.commit()
         except:
-            logMsg(ERROR, "Failed to get used fund.")
-            used_fund = -1
+            logMsg(ERROR, "Failed to confirm fund reservation.")
 
-        if used_fund is None:
-            used_fund = 0
+    @timed("db_release_job")
+    def release_job(self):
+        """
+        Removes the last reserved job from the reservation
+        """
 
-        return used_fund
+        try:
+            cur = self.conn.cursor()
+            cur.execute("ROLLBACK TO SAVEPOINT reservation;")
+            cur.execute("RELEASE SAVEPOINT reservation;")
+            cur.close()
+        except:
+            # the whole reservation is rolled back
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to release fund reservation.")
 
-    def get_used_count(self, owner):
+    @timed("db_commit")
+    def commit(self):
         if not self.is_connected():
-            return -1
-
-        owner = self.sanitize(owner)
+            return
 
-        used_count = -1
+        try:
+            self.conn.commit()
+        except:
+            logMsg(ERROR, "Failed to commit fund reservation.")
 
-        sql = "SELECT COUNT (cputime) AS total_count FROM %s \
-WHERE owner = '%s';" % (self.table_name, owner)
+    def rollback(self):
+        if not self.is_connected():
+            return
 
         try:
-            cur = self.conn.cursor()
-            cur.execute(sql)
-            used_count = cur.fetchone()[0]
-            cur.close()
-            self.conn.commit()
+            self.conn.rollback()
         except:
-            logMsg(ERROR, "Failed to get used count.")
-            used_count = -1
+            pass
+
+    def query_usage(self, cur, owner, seconds):
+        """
+        Reads the usage in the current transaction
+        """
 
-        if used_count is None:
-            used_count = 0
+        self.execute(cur, "get_usage", (owner, seconds))
+        usage = cur.fetchone()
 
-        return used_count
+        if usage is not None and not usage[3]:
+            self.execute(cur, "count_usage", (owner, seconds))
+            usage = cur.fetchone()
 
-    def get_full_list(self):
-        if not self.is_connected():
-            return []
+        if usage is None:
+            return (0, 0, None)
 
-        full_list = []
+        return (usage[0], usage[1], usage[2])
 
-        sql = "SELECT owner, COUNT(cputime) AS count, \
-SUM (cputime) AS total_cputime FROM %s GROUP BY owner;" % self.table_name
+    @timed("db_get_usage")
+    def get_usage(self, owner, seconds):
+        """
+        Gets used count, used fund and earliest record timeout
+        of the owner from the usage summary. The records are counted
+        only if the owner has some expired record not cleaned yet.
+        Returns (-1, -1, None) on failure.
+        """
+
+        if not self.is_connected():
+            return (-1, -1, None)
 
         try:
             cur = self.conn.cursor()
-            cur.execute(sql)
-            full_list = cur.fetchall()
+            usage = self.query_usage(cur, owner, seconds)
             cur.close()
             self.conn.commit()
         except:
-            logMsg(ERROR, "Failed to get the list.")
-            full_list = []
+            logMsg(ERROR, "Failed to get used fund and count.")
+            return (-1, -1, None)
 
-        return full_list
+        return usage
 
-    def get_earliest_record_timeout(self, owner, seconds):
-        if not self.is_connected():
-            return None
+    def get_full_list(self, seconds, filters):
+        """
+        Yields (owner, count, cputime, earliest timeout) ordered by owner
+        from the usage summary, owners with expired records
+        not cleaned yet are counted from the records.
+        The rows are fetched by a server-side cursor in chunks.
 
-        owner = self.sanitize(owner)
-        seconds = self.sanitize(seconds)
+        filters - dict with optional owner (regex), realm, min_cputime,
+                  min_count, limit and offset
+        """
+
+        if not self.is_connected():
+            return
 
-        earliest_timeout = None
+        params = (seconds, filters.get("owner"), filters.get("realm"),
+                  filters.get("min_cputime"), filters.get("min_count"),
+                  filters.get("limit"), filters.get("offset"))
 
         try:
-            cur = self.conn.cursor()
-            sql = "SELECT MIN(date) + interval '%d second' as earliest \
-FROM %s WHERE owner = '%s';" % (seconds, self.table_name, owner)
-            cur.execute(sql)
-            earliest_timeout = cur.fetchone()[0]
+            cur = self.conn.cursor(name="full_list")
+            cur.itersize = 1000
+            self.execute(cur, "get_full_list", params)
+            for row in cur:
+                yield row
             cur.close()
             self.conn.commit()
-        except:
-            logMsg(ERROR, "Failed to get earliest record timeout for %s."
-                   % owner)
-            earliest_timeout = None
-
-        return earliest_timeout
+        except Exception:
+            # not a bare except, the consumer may close the generator
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to get the list.")
 
+    @timed("db_clean_owner")
     def clean_owner(self, owner):
         if not self.is_connected():
             return
 
-        owner = self.sanitize(owner)
-
         try:
             cur = self.conn.cursor()
-            sql = "DELETE FROM %s WHERE owner = '%s';" \
-                  % (self.table_name, owner)
-            cur.execute(sql)
+            self.execute(cur, "clean_owner", (owner,))
+            self.execute(cur, "clean_owner_usage", (owner,))
             cur.close()
             self.conn.commit()
         except:
             logMsg(ERROR, "Failed to delete %s's records." % owner)
 
+    @timed("db_clean_old")
     def clean_old(self, seconds):
         if not self.is_connected():
             return
 
-        seconds = self.sanitize(seconds)
+        if self.partition_secs > 0:
+            self.drop_old_partitions(seconds)
+            self.ensure_partitions(seconds)
+
+        table = self.table_name
 
         try:
             cur = self.conn.cursor()
-            sql = "DELETE FROM %s WHERE date < NOW() - interval '%d second';\
-" % (self.table_name, seconds)
-            cur.execute(sql)
+            # inserts wait, so the recounted summary is exact
+            cur.execute("LOCK TABLE %s_usage IN SHARE ROW EXCLUSIVE MODE;"
+                        % table)
+            cur.execute("DELETE FROM " + table + " \
+WHERE date < NOW() - %s * interval '1 second';", (seconds,))
+            # recount owners having expired records
+            cur.execute("CREATE TEMPORARY TABLE stale ON COMMIT DROP AS \
+SELECT owner FROM " + table + "_usage \
+WHERE earliest <= NOW() - %s * interval '1 second';", (seconds,))
+            cur.execute("DELETE FROM %s_usage \
+WHERE owner IN (SELECT owner FROM stale);" % table)
+            cur.execute("INSERT INTO %s_usage (owner, count, cputime, earliest) \
+SELECT owner, COUNT(cputime), SUM(cputime), MIN(date) FROM %s \
+WHERE owner IN (SELECT owner FROM stale) GROUP BY owner;" % (table, table))
             cur.close()
             self.conn.commit()
         except:
+            self.conn.rollback()
             logMsg(ERROR, "Failed to clean old records.")
 
-    def sanitize(self, to_check):
-        forbidden_chars = [";", "'", '"']
-        safe_str = "__u_n_k_n_o_w_n__"
+    @timed("db_check_usage")
+    def check_usage(self):
+        """
+        Compares the usage summary with the records and rebuilds it.
+        Returns number of inconsistent owners or -1 on failure.
+        """
+
+        if not self.is_connected():
+            return -1
+
+        table = self.table_name
 
-        if (type(to_check) == int):
-            return to_check
+        try:
+            cur = self.conn.cursor()
+            cur.execute("LOCK TABLE %s_usage IN SHARE ROW EXCLUSIVE MODE;"
+                        % table)
+            cur.execute("CREATE TEMPORARY TABLE recounted ON COMMIT DROP AS \
+SELECT owner, COUNT(cputime) AS count, SUM(cputime) AS cputime, \
+MIN(date) AS earliest FROM %s GROUP BY owner;" % table)
+            cur.execute("SELECT COUNT(*) FROM recounted r \
+FULL JOIN %s_usage u ON u.owner = r.owner \
+WHERE u.owner IS NULL OR r.owner IS NULL OR u.count <> r.count \
+OR u.cputime <> r.cputime OR u.earliest <> r.earliest;" % table)
+            inconsistent = cur.fetchone()[0]
+            cur.execute("DELETE FROM %s_usage;" % table)
+            cur.execute("INSERT INTO %s_usage (owner, count, cputime, earliest) \
+SELECT owner, count, cputime, earliest FROM recounted;" % table)
+            cur.close()
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logMsg(ERROR, "Failed to check usage summary: %s" % e)
+            return -1
 
-        if (type(to_check) == str):
-            if len(to_check) == 0:
-                to_check = safe_str
+        return inconsistent
 
-            for i in forbidden_chars:
-                if to_check.find(i) != -1:
-                    to_check = safe_str
 
-        else:
-            to_check = safe_str
+# results of the job extension
+GRANTED = "granted"
+NOT_FOUND = "not_found"
+NOT_ALLOWED = "not_allowed"
+INVALID_JOB = "invalid_job"
+MOVED = "moved"
+QUEUE_LIMIT = "queue_limit"
+RESERVATION_CONFLICT = "reservation_conflict"
+COUNT_EXCEEDED = "count_exceeded"
+FUND_EXCEEDED = "fund_exceeded"
+ALTER_FAILED = "alter_failed"
+SERVER_ERROR = "server_error"
+# limits binding the quote only
+NODE_BLOCKED = "node_blocked"
+DEDICATED_TIME = "dedicated_time"
+
+
+def is_job_array(jobid):
+    """
+    Checks jobid is a job array or range of subjobs (not a single subjob)
+    """
+
+    return re.match(r'^[0-9]+\[[0-9]*[^0-9\]][^\]]*\]|^[0-9]+\[\]',
+                    jobid) is not None
+
+
+def array_range(jobid):
+    """
+    Returns (array number, [(first, last, step), ...]) of a job array
+    '123[]' (None instead of the list, all subjobs) or range of subjobs
+    '123[1-5:2,8]', None if not parsable
+    """
+
+    match = re.match(r'^([0-9]+)\[([^\]]*)\]', jobid)
+    if match is None:
+        return None
+
+    if len(match.group(2)) == 0:
+        return (match.group(1), None)
+
+    ranges = []
+    try:
+        for part in match.group(2).split(","):
+            step = 1
+            if ":" in part:
+                part, step = part.split(":", 1)
+                step = int(step)
+            first, sep, last = part.partition("-")
+            ranges.append((int(first), int(last or first), max(step, 1)))
+    except ValueError:
+        return None
+
+    return (match.group(1), ranges)
+
+
+def in_array_range(array, seq):
+    """
+    Checks the subjob seq '123[4]' is in the array_range() array
+    """
+
+    match = re.match(r'^([0-9]+)\[([0-9]+)\]$', seq)
+    if array is None or match is None or match.group(1) != array[0]:
+        return False
+
+    if array[1] is None:
+        return True
+
+    index = int(match.group(2))
+    for first, last, step in array[1]:
+        if first <= index <= last and (index - first) % step == 0:
+            return True
+
+    return False
+
+
+# multipliers of the size suffixes of PBS resources
+SIZE_UNITS = {"kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3,
+              "tb": 1024 ** 4, "pb": 1024 ** 5,
+              "kw": 8 * 1024, "mw": 8 * 1024 ** 2, "gw": 8 * 1024 ** 3,
+              "tw": 8 * 1024 ** 4, "pw": 8 * 1024 ** 5,
+              "b": 1, "w": 8}
+
+
+resource_re_cache = {}
+
+
+def resource_re(name):
+    """
+    Compiled regexp of the numeric resource values in exec_vnode,
+    matches (number, size suffix)
+    """
+
+    if name not in resource_re_cache:
+        resource_re_cache[name] = re.compile(
+            r':%s=([0-9]+)([a-zA-Z]*)(?=[:+)]|$)' % re.escape(name))
+
+    return resource_re_cache[name]
+
+
+class Exec_vnode(object):
+    """
+    Parsed exec_vnode '(vn1:ncpus=4:mem=4gb+vn2:ncpus=4)+(vn3:ngpus=1)'.
+    The totals of a resource are read by one regexp scan of the whole
+    string, the vnodes are split out only when asked for, so jobs
+    with thousands of chunks cost no per-chunk Python work.
+    No per-vnode resource table is kept: nothing reads it, and
+    filling it chunk by chunk in Python was slower than the former
+    per-chunk regexp (see bench/exec_vnode.py).
+    """
+
+    def __init__(self, exec_vnode):
+        self.value = exec_vnode
+        self.pieces = 0
+        if len(exec_vnode) > 0:
+            self.pieces = exec_vnode.count("+") + 1
+        # [(vnode, ':', 'res=value:...'), ...]
+        self.chunks = None
+        self.totals = {}
+
+    def split(self):
+        if self.chunks is None:
+            self.chunks = []
+            if self.pieces > 0:
+                self.chunks = [piece.strip("()").partition(":")
+                               for piece in self.value.split("+")]
+
+        return self.chunks
+
+    def vnodes(self):
+        """
+        Returns the distinct vnodes in the order of exec_vnode
+        """
+
+        return list(dict.fromkeys(chunk[0] for chunk in self.split()
+                                  if len(chunk[0]) > 0))
+
+    def total(self, name, default=0):
+        """
+        Returns the sum of the numeric resource over all the chunks,
+        default is counted for the chunks without the resource
+        """
+
+        key = (name, default)
+        if key not in self.totals:
+            values = resource_re(name).findall(self.value)
+            self.totals[key] = default * (self.pieces - len(values)) + \
+                self.sum_values(values)
+
+        return self.totals[key]
+
+    def sum_values(self, values):
+        """
+        Sums [(number, size suffix), ...], in bytes for sizes
+        """
+
+        if len(values) > 1:
+            numbers, suffixes = zip(*values)
+            suffixes = set(suffixes)
+            if len(suffixes) == 1:
+                # all in the same units, PBS writes mem in kb
+                suffix = suffixes.pop()
+                multiplier = 1
+                if len(suffix) > 0:
+                    multiplier = SIZE_UNITS.get(suffix.lower(), 0)
+                return sum(map(int, numbers)) * multiplier
+
+        total = 0
+        for number, suffix in values:
+            if len(suffix) == 0:
+                total += int(number)
+            else:
+                total += int(number) * SIZE_UNITS.get(suffix.lower(), 0)
+
+        return total
+
+
+def parse_exec_host(exec_host):
+    """
+    Returns the distinct hosts of exec_host 'host1/0*4+host2/1*2'
+    """
+
+    hosts = {}
+    for piece in exec_host.split("+"):
+        host = piece.split("/", 1)[0]
+        if len(host) > 0:
+            hosts[host] = True
+
+    return list(hosts.keys())
+
+
+# attributes requested from the PBS server, nothing else is serialized
+SERVER_ATTRS = ["server_host"]
+JOB_ATTRS = ["job_state", "Job_Owner", "Resource_List.walltime",
+             "exec_vnode", "exec_host", "queue", "stime", "array"]
+QUEUE_ATTRS = ["resources_max.walltime"]
+RESV_ATTRS = ["reserve_start", "resv_nodes"]
+
+attrl_cache = {}
+# the daemon workers share the lists, a list replaced by another thread
+# would free the attrl nodes still reached by the first one
+attrl_lock = threading.Lock()
+
+
+def create_attrl(names):
+    """
+    Creates attrl list of the attribute names
+    (name.resource for resources) for the stat calls.
+    The lists are created once and kept alive by the cache.
+    """
+
+    key = tuple(names)
+    with attrl_lock:
+        if key in attrl_cache:
+            return attrl_cache[key][0]
+
+        attrs = []
+        for name in names:
+            a = pbs_ifl.attrl()
+            if "." in name:
+                a.name, a.resource = name.split(".", 1)
+            else:
+                a.name = name
+                a.resource = None
+            a.value = None
+            a.next = None
+
+            if len(attrs) > 0:
+                attrs[-1].next = a
+            attrs.append(a)
+
+        attrl_cache[key] = (attrs[0], attrs)
+
+        return attrs[0]
+
+
+class Status_cache(object):
+    """
+    Status of PBS queues, nodes and reservations keyed by
+    (server, type, name). An entry is used while it is younger than ttl
+    seconds, or if it was fetched by the current request, so a request
+    never queries the same object twice even with ttl = 0.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, server, what, name, since):
+        """
+        Returns the cached info, None if missing or expired.
+        since is the start of the request.
+        """
+
+        key = (server, what, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            fetched, info = entry
+            if fetched >= since or time.time() - fetched < self.ttl:
+                return info
+
+            del self.entries[key]
+
+        return None
+
+    def put(self, server, what, infos):
+        """
+        Stores the infos, only plain copies are kept
+        so the PBS status lists are freed
+        """
+
+        now = time.time()
+        with self.lock:
+            for info in infos:
+                self.entries[(server, what, info["id"])] = (now, dict(info))
+
+    def put_object(self, server, what, name, obj):
+        """
+        Stores an object derived from the status, e.g. an index
+        """
+
+        with self.lock:
+            self.entries[(server, what, name)] = (time.time(), obj)
+
+    def invalidate(self, server=None, what=None, name=None):
+        """
+        Drops the matching entries, all of them by default
+        """
+
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if server is not None and key[0] != server:
+                    continue
+                if what is not None and key[1] != what:
+                    continue
+                if name is not None and key[2] != name:
+                    continue
+                del self.entries[key]
+
+
+# shared by the requests of the daemon, see status_ttl
+status_cache = Status_cache(30)
+
+
+class Reservation_horizon(object):
+    """
+    Start times of the reservations per node, sorted,
+    built from one stat of all the reservations of a server
+    """
+
+    def __init__(self, resvs):
+        # node -> [(reserve_start, resv), ...]
+        self.starts = {}
+
+        for info in resvs:
+            if "reserve_start" not in info.keys() or \
+               "resv_nodes" not in info.keys():
+                # not confirmed yet, no nodes assigned
+                continue
+
+            start = int(info["reserve_start"])
+            nodes = set(chunk.strip("()").split(":")[0]
+                        for chunk in info["resv_nodes"].split("+"))
+            for node in nodes:
+                bisect.insort(self.starts.setdefault(node, []),
+                              (start, info["id"]))
+
+    def earliest(self, nodes):
+        """
+        Returns (reserve_start, resv) of the first reservation
+        on any of the nodes, i.e. the latest safe end time of a job
+        running on them, (None, None) if there is none
+        """
+
+        first = (None, None)
+        for node in nodes:
+            starts = self.starts.get(node)
+            if starts and (first[0] is None or starts[0] < first):
+                first = starts[0]
+
+        return first
+
+
+# server_host of the servers connected so far {server_name: server_host}
+server_hosts = {}
+
+# moved jobs are followed at most this number of servers further
+MAX_MOVED_HOPS = 3
 
-        return to_check
+
+def close_servers(conns):
+    """
+    Disconnects the kept PBS connections
+    {server_name: (c, server_host)}, a connection may be kept
+    under more names
+    """
+
+    for c in set(c for c, server_host in conns.values()):
+        try:
+            pbs_ifl.pbs_disconnect(c)
+        except:
+            pass
+
+    conns.clear()
+
+
+class Job(object):
+    """
+    Job to be extended and the result of its extension
+    """
+
+    def __init__(self, jobid, affect_fund):
+        self.jobid = jobid
+        self.job_info = None
+        self.server_name = None
+        self.ncpus = 0
+        self.cputime = 0
+        self.current_walltime = 0
+        self.new_walltime = 0
+        self.affect_fund = affect_fund
+        self.result = None
+        self.message = ""
+        # parsed exec_vnode, see Exec_vnode
+        self.exec_vnode = None
+        # cputime charged per second of the extension and its details
+        self.rate = 0.0
+        self.charge = None
+        # largest extension in seconds and the limit binding it,
+        # computed by quote(), None if nothing binds
+        self.max_extension = None
+        self.binding = None
 
 
 class Walltime_extender(object):
@@ -338,148 +1810,151 @@ class Walltime_extender(object):
     PBS walltime extender class
     """
 
-    def __init__(self, argv):
+    def __init__(self, argv, db=None, conns=None):
         """
         Init
+
+        db - already connected Database to be used (kept open by caller)
+        conns - dict of kept PBS connections {server_name: (c, server_host)},
+                the connections are closed by finish() if not given
         """
 
         self.server_host = None
         self.c = None
-        self.ncpus = 0
-        self.cputime = 0
-        self.current_walltime = 0
-        self.new_walltime = 0
         self.admin = False
         self.force = False
         self.affect_fund = True
-        self.db = None
+        self.db = db
+        self.own_db = db is None
+        self.conns = conns
+        self.own_conns = conns is None
+        if self.conns is None:
+            self.conns = {}
+        self.hops = 0
+
+        self.jobid = None
+        self.jobids = []
+        self.jobs = []
+        self.batch = False
+        self.usage = {}
+        self.started = time.time()
+        self.output_json = False
 
         self.do_extension = False
+        self.do_quote = False
+        self.invalid_args = False
         self.show_info = False
         self.show_full_list = False
         self.reset_owner = None
         self.info_owner = None
+        self.command = None
+        self.json_out = {}
+        self.list_filters = {}
+        self.list_ndjson = False
 
-        self.clean_secs = 2592000
-        self.fund = 10368000
-        self.count = 20
-        self.owner_re = r'^[a-z][a-z0-9_-]{1,14}@[A-Z0-9\._-]+$'
-        self.admin_re = r'NOTHING'
-        self.list_re = r'.*'
-
-        self.preparsed_fund = ""
-        self.preparsed_count = ""
-
-        cfg = config(section="general")
-
-        if "clean_secs" in cfg.keys():
-            self.clean_secs = self.human2sec(cfg["clean_secs"])
-
-        if "fund" in cfg.keys():
-            self.preparsed_fund = cfg["fund"]
+        argv = list(argv)
 
-        if "count" in cfg.keys():
-            self.preparsed_count = cfg["count"]
+        if "--json" in argv:
+            argv.remove("--json")
+            self.output_json = True
 
-        if "owner_re" in cfg.keys():
-            self.owner_re = r'%r' % cfg["owner_re"]
-            self.owner_re = self.owner_re[1:-1]
+        # the messages are collected for the JSON output, see print_json()
+        request_ctx.messages = [] if self.output_json else None
 
-        if "admin_re" in cfg.keys():
-            self.admin_re = r'%r' % cfg["admin_re"]
-            self.admin_re = self.admin_re[1:-1]
+        try:
+            self.rules = get_rules()
+            self.node_policy = get_node_policy()
+            self.charging = get_charging()
+        except Exception as e:
+            logMsg(ERROR, "Invalid configuration: %s" % e)
+            self.cmd_owner = None
+            self.invalid_args = True
+            return
 
-        if "list_re" in cfg.keys():
-            self.list_re = r'%r' % cfg["list_re"]
-            self.list_re = self.list_re[1:-1]
+        self.clean_secs = self.rules.clean_secs
 
-        self.cmd_owner = os.getenv("REMOTE_USER")
+        self.cmd_owner = remote_env("REMOTE_USER")
         if self.cmd_owner is None or len(self.cmd_owner) == 0:
             logMsg(ERROR, "Missing REMOTE_USER environmental variable.")
             self.print_help()
             return
 
-        if not re.match(self.owner_re, self.cmd_owner):
+        if not self.rules.valid_owner(self.cmd_owner):
             logMsg(ERROR, "Illegal format of REMOTE_USER.")
             self.print_help()
             return
 
-        for r in self.preparsed_fund.split(","):
-            rule = r.split(":")
-            if len(rule) != 2:
-                continue
-            [rule_re, rule_value] = rule
-            rule_re = rule_re.strip()
-            rule_value = rule_value.strip()
-            rule_re = r'%r' % rule_re
-            rule_re = rule_re[1:-1]
-
-            if re.match(rule_re, self.cmd_owner):
-                self.fund = int(rule_value)
-                break
-
-        for r in self.preparsed_count.split(","):
-            rule = r.split(":")
-            if len(rule) != 2:
-                continue
-            [rule_re, rule_value] = rule
-            rule_re = rule_re.strip()
-            rule_value = rule_value.strip()
-            rule_re = r'%r' % rule_re
-            rule_re = rule_re[1:-1]
-
-            if re.match(rule_re, self.cmd_owner):
-                self.count = self.human2sec(rule_value)
-                break
+        self.fund = self.rules.fund(self.cmd_owner)
+        self.count = self.rules.count(self.cmd_owner)
 
-        if len(self.admin_re) > 0 and re.match(self.admin_re, self.cmd_owner):
-            print("You are the admin. Your cputime fund will not be affected.")
+        if self.rules.is_admin(self.cmd_owner):
+            show_msg("You are the admin. \
+Your cputime fund will not be affected.")
             self.admin = True
             self.affect_fund = False
 
-        if "-f" in sys.argv:
-            sys.argv.remove("-f")
+        if "-f" in argv:
+            argv.remove("-f")
             if self.admin:
                 self.force = True
             else:
-                print("You need to be the admin to use '-f' parameter.")
+                show_msg("You need to be the admin to use '-f' parameter.")
+
+        if len(argv) >= 2 and argv[1] in ["info", "list", "reset", "quote"]:
+            self.command = argv[1]
+        elif len(argv) > 2:
+            self.command = "extend"
 
-        if len(argv) == 2 and sys.argv[1] == 'info':
+        if len(argv) == 2 and argv[1] == 'info':
             self.show_info = True
-        elif len(argv) == 3 and sys.argv[1] == 'info':
-            if len(sys.argv[2]) > 0:
-                if self.cmd_owner == sys.argv[2]:
+        elif len(argv) == 3 and argv[1] == 'info':
+            if len(argv[2]) > 0:
+                if self.cmd_owner == argv[2]:
                     self.show_info = True
                 else:
                     if not self.admin:
                         logMsg(ERROR, "You are not allowed to show others info.")
                         self.print_help()
                         return
-                    self.info_owner = sys.argv[2]
+                    self.info_owner = argv[2]
                 self.show_info = True
             else:
                 self.print_help()
                 return
-        elif len(argv) == 2 and sys.argv[1] == 'list':
+        elif len(argv) >= 2 and argv[1] == 'list':
             if not self.admin:
                 logMsg(ERROR, "You are not allowed to show full list.")
                 self.print_help()
                 return
+            if not self.parse_list_options(argv[2:]):
+                self.print_help()
+                return
             if self.admin:
                 self.show_full_list = True
-        elif len(argv) == 3 and sys.argv[1] == 'reset':
+        elif len(argv) == 3 and argv[1] == 'reset':
             if not self.admin:
                 logMsg(ERROR, "You are not allowed to reset fund.")
-            if (self.admin and len(sys.argv[2]) > 0):
-                self.reset_owner = sys.argv[2]
+            if (self.admin and len(argv[2]) > 0):
+                self.reset_owner = argv[2]
                 self.affect_fund = True
             else:
                 self.print_help()
                 return
+        elif len(argv) > 2 and argv[1] == 'quote':
+            # checked as a batch, nothing is altered
+            self.jobids = self.parse_jobids(argv[2:])
+            self.additional_walltime = 0
+            self.do_quote = True
+            self.batch = True
         elif len(argv) > 2:
-            self.jobid = sys.argv[1]
-            self.additional_walltime = sys.argv[2]
+            self.jobids = self.parse_jobids(argv[1:-1])
+            self.additional_walltime = argv[-1]
             self.do_extension = True
+
+            if len(self.jobids) == 1 and not is_job_array(self.jobids[0]):
+                self.jobid = self.jobids[0]
+            else:
+                self.batch = True
         else:
             self.print_help()
             return
@@ -490,94 +1965,145 @@ class Walltime_extender(object):
                 self.print_help()
                 return
 
-            self.connect_server()
+            self.additional_walltime = human2sec(self.additional_walltime)
+
+            if self.batch:
+                if len(self.jobids) == 0:
+                    logMsg(ERROR, "No jobid given.")
+                    self.print_help()
+                    return
+            else:
+                self.connect_server()
+
+                if self.adjust_jobid():
+                    self.disconnect_server()
+                    self.connect_server(self.server_host)
+
+        if self.own_db:
+            self.db = Database()
+            if self.db.connect():
+                return
+
+    def parse_jobids(self, args):
+        """
+        Returns the jobids of the arguments, '-' reads them from stdin
+        """
+
+        jobids = []
+        for jobid in args:
+            if jobid == "-":
+                jobids += request_stdin().split()
+            else:
+                jobids.append(jobid)
+
+        return jobids
+
+    def parse_list_options(self, options):
+        """
+        Parses the filters, paging and format of the list command
+        """
+
+        names = {"--owner": "owner", "--realm": "realm",
+                 "--min-cputime": "min_cputime", "--min-count": "min_count",
+                 "--limit": "limit", "--offset": "offset"}
+
+        options = list(options)
+        while len(options) > 0:
+            option = options.pop(0)
+
+            if option == "--ndjson":
+                self.list_ndjson = True
+                continue
 
-            self.additional_walltime = self.human2sec(self.additional_walltime)
-            if self.adjust_jobid():
-                self.disconnect_server()
-                self.connect_server(self.server_host)
+            if option not in names or len(options) == 0:
+                logMsg(ERROR, "Invalid list option %s." % option)
+                return False
 
-        self.db = Database()
-        if self.db.connect():
-            return
+            value = options.pop(0)
+            try:
+                if option == "--owner":
+                    re.compile(value)
+                elif option == "--min-cputime":
+                    value = human2sec(value)
+                elif option != "--realm":
+                    value = int(value)
+                    if value < 0:
+                        raise ValueError
+            except:
+                logMsg(ERROR, "Invalid value of %s." % option)
+                return False
 
-        self.db.clean_old(self.clean_secs)
+            self.list_filters[names[option]] = value
+
+        return True
 
     def print_help(self):
         """
-        Prints help
+        Prints help, nothing is checked nor altered afterwards
         """
         self.cmd_owner = None
         self.jobid = None
         self.additional_walltime = None
+        self.do_extension = False
+        self.do_quote = False
+        self.invalid_args = True
+
+        if self.output_json:
+            show_msg("Invalid parameters.", ERROR)
+            return
+
         print("Usage:")
-        print("remctl <pbs_server> pbs-extend \
-[<jobid> <additional_walltime>]|info|list|[reset <principal>]")
+        print("remctl <pbs_server> pbs-extend [-f] [--json] \
+[<jobid> [<jobid> ...] <additional_walltime>]|info|list|[reset <principal>]")
+        print("remctl <pbs_server> pbs-extend [-f] [--json] quote \
+<jobid> [<jobid> ...]")
+        print("remctl <pbs_server> pbs-extend [--json] list \
+[--owner <regex>] [--realm <realm>] [--min-cputime <walltime>] \
+[--min-count <count>] [--limit <n>] [--offset <n>] [--ndjson]")
         print("")
         print(" - A valid kerberos ticket needs to be issued before running.")
         print(" - Allowed jobid formats: \
 123|123.servername|123.original_servername@target_servername")
+        print(" - Job arrays (123[].servername) extend all their subjobs, \
+'-' reads jobids from stdin.")
         print(" - Allowed additional_walltime formats: \
 <seconds>|<h+:mm:ss>")
+        print(" - 'quote' shows the largest extension that would be granted \
+and the limit binding it.")
 
-    def human2sec(self, h):
-        """
-        Converts hh:mm:ss to seconds
-        """
-
-        a = h.split(":")
-
-        s = 0
-
-        if len(a) > 0:
-            s += int(a[len(a) - 1])
-        if len(a) > 1:
-            s += int(a[len(a) - 2]) * 60
-        if len(a) > 2:
-            s += int(a[len(a) - 3]) * 60 * 60
-
-        return s
-
-    def sec2human(self, s):
+    def job_exec_vnode(self, job):
         """
-        Converts seconds to hh:mm:ss
+        Returns Exec_vnode of the job, parsed only once
+        for the fund and the node checks
         """
 
-        h = ""
-
-        hours = int(s / 60 / 60)
-        s = s % (60 * 60)
+        if job.exec_vnode is None:
+            job.exec_vnode = Exec_vnode(job.job_info.get("exec_vnode", ""))
 
-        mins = int(s / 60)
-        s = s % 60
+        return job.exec_vnode
 
-        secs = int(s)
-
-        h = "%02d:%02d:%02d" % (hours, mins, secs)
-        return h
-
-    def get_ncpus(self, exec_vnode):
+    def get_ncpus(self, job):
         """
-        Gets total number of ncpus from exec_vnode
+        Gets total number of ncpus from exec_vnode,
+        a chunk without ncpus counts as one
         """
-        ncpus = 0
-
-        for i in exec_vnode.split("+"):
-            node_ncpus = 1
-            match = re.match(r'.*ncpus=([0-9]+).*', i)
-            if match:
-                node_ncpus *= int(match.group(1))
-            ncpus += node_ncpus
 
-        return ncpus
+        return self.job_exec_vnode(job).total("ncpus", 1)
 
     def connect_server(self, server_name=None):
         """
-        Connect to PBS server
+        Connect to PBS server. The connection is kept in conns
+        under the server name and its server_host, the server_host
+        is queried only once per process.
         """
 
+        if server_name in self.conns:
+            self.c, self.server_host = self.conns[server_name]
+            return
+
         try:
-            self.c = pbs_ifl.pbs_connect(server_name)
+            with metrics.timer("pbs_connect"):
+                self.c = pbs_ifl.pbs_connect(server_name)
         except:
             self.c = None
 
@@ -586,30 +2112,52 @@ class Walltime_extender(object):
             self.c = None
             return
 
-        server_info = []
-        try:
-            server_info = pbs_ifl.pbs_statserver(self.c, None, None)
-        except:
-            logMsg(ERROR, "Failed to get server info. Try again later.")
-            self.c = None
+        if server_name in server_hosts:
+            self.server_host = server_hosts[server_name]
+        else:
             server_info = []
+            try:
+                with metrics.timer("pbs_statserver"):
+                    server_info = pbs_ifl.pbs_statserver(
+                        self.c, create_attrl(SERVER_ATTRS), None)
+            except:
+                server_info = []
 
-        if len(server_info) > 0:
-            server_info = server_info[0]
-            self.server_host = server_info["server_host"]
+            if len(server_info) == 0:
+                logMsg(ERROR, "Failed to get server info. Try again later.")
+                try:
+                    pbs_ifl.pbs_disconnect(self.c)
+                except:
+                    pass
+                self.c = None
+                return
+
+            self.server_host = server_info[0]["server_host"]
+            server_hosts[server_name] = self.server_host
+
+        self.conns[server_name] = (self.c, self.server_host)
+        if self.server_host not in self.conns:
+            self.conns[self.server_host] = (self.c, self.server_host)
 
     def disconnect_server(self):
         """
         Disconnect from PBS server
         """
 
-        if self.c is None:
+        # the connection is kept in conns, see disconnect_servers()
+        self.c = None
+
+    def disconnect_servers(self):
+        """
+        Disconnect from all PBS servers of the request
+        """
+
+        self.c = None
+
+        if not self.own_conns:
             return
 
-        try:
-            ret = pbs_ifl.pbs_disconnect(self.c)
-        finally:
-            self.c = None
+        close_servers(self.conns)
 
     def adjust_jobid(self):
         """
@@ -641,7 +2189,84 @@ class Walltime_extender(object):
         # Needs reconnect
         return True
 
-    def check_count(self):
+    def job_failed(self, job, result, lvl, msg):
+        """
+        Marks the job as not extended, the message is printed
+        for a single job and kept for the report in batch mode
+        """
+
+        job.result = result
+        job.message = ANSI_ESCAPE.sub('', msg)
+        logMsg(lvl, msg, echo=not self.batch)
+
+        return False
+
+    def check_limits(self, jobs):
+        """
+        Checks allowed number of jobs and cputime fund
+        for all the jobs affecting fund together.
+        The jobs are accepted in order while they fit the limits.
+        The owner stays locked until adjust_fund(), so concurrent
+        requests of the owner cannot pass the same check.
+        """
+
+        jobs = [job for job in jobs if job.affect_fund]
+        if len(jobs) == 0:
+            return True
+
+        used_count, used_fund, earliest_timeout = \
+            self.db.lock_owner(self.cmd_owner, self.clean_secs)
+
+        ok = True
+        for job in jobs:
+            job.cputime = int(round(job.rate * self.additional_walltime))
+            job.charge["walltime"] = self.additional_walltime
+
+            if not self.check_count(used_count):
+                self.job_failed(job, COUNT_EXCEEDED, INFO,
+                                f"Number of extensions {bcolors.FAIL}exceeds \
+%d{bcolors.ENDC}." % self.count)
+                self.show_info = True
+                ok = False
+                continue
+
+            if not self.check_fund(job, used_fund):
+                avail_walltime = 0
+                if used_fund >= 0 and job.rate > 0:
+                    avail_walltime = max(self.fund - used_fund, 0) / job.rate
+
+                self.job_failed(job, FUND_EXCEEDED, INFO,
+                                f"Requested walltime {bcolors.FAIL}exceeds \
+%s's cputime fund{bcolors.ENDC}." % self.cmd_owner)
+
+                msg = "Possible walltime extension for the job %s is %s." \
+                    % (job.jobid, sec2human(avail_walltime))
+                if self.batch:
+                    job.message += " " + msg
+                else:
+                    show_msg(msg)
+
+                self.show_info = True
+                ok = False
+                continue
+
+            used_count += 1
+            used_fund += job.cputime
+
+        return ok
+
+    def get_usage(self, owner):
+        """
+        Gets (used count, used fund, earliest record timeout) of the owner,
+        queried once per request
+        """
+
+        if owner not in self.usage:
+            self.usage[owner] = self.db.get_usage(owner, self.clean_secs)
+
+        return self.usage[owner]
+
+    def check_count(self, used_count):
         """
         Checks allowed number of jobs
         """
@@ -649,8 +2274,6 @@ class Walltime_extender(object):
         if self.count == 0:
             return False
 
-        used_count = self.db.get_used_count(self.cmd_owner)
-
         if used_count < 0:
             return False
 
@@ -659,22 +2282,16 @@ class Walltime_extender(object):
 
         return True
 
-    def check_fund(self):
+    def check_fund(self, job, used_fund):
         """
-        Checks cputime fund
+        Checks cputime fund, a job charged nothing
+        (free queue, no weighted resource) always fits
         """
 
-        self.cputime = self.ncpus * self.additional_walltime
-
-        if self.cputime == 0:
-            return False
-
-        used_fund = self.db.get_used_fund(self.cmd_owner)
-
         if used_fund < 0:
             return False
 
-        if self.cputime > self.fund - used_fund:
+        if job.cputime > self.fund - used_fund:
             return False
 
         return True
@@ -682,13 +2299,15 @@ class Walltime_extender(object):
     def adjust_fund(self):
         """
         Once the walltime has been extended,
-        alter cputime fund
+        commits the fund reserved for the granted jobs
+        and releases the owner lock
         """
 
-        if not self.affect_fund:
+        if not self.db:
             return
 
-        self.db.insert_job(self.jobid, self.cmd_owner, self.cputime)
+        self.db.commit()
+        self.usage.pop(self.cmd_owner, None)
 
     def check_walltime_format(self):
         """
@@ -713,141 +2332,250 @@ class Walltime_extender(object):
 
         return True
 
-    def check_max_walltime(self, job_info):
+    def queue_limit(self, job):
         """
-        Checks the queue max walltime limit
+        Returns the max walltime of the job's queue in seconds,
+        0 if the queue has no limit, None on failure
         """
 
         if self.c is None:
             logMsg(ERROR, "No connection to server.")
-            return False
+            return None
 
-        queue = job_info["queue"]
+        queue = job.job_info["queue"]
 
         if not queue:
             logMsg(ERROR, "Missing queue on job.")
-            return False
-
-        try:
-            queue_info = pbs_ifl.pbs_statque(self.c, queue, None, None)
-        except:
-            logMsg(ERROR, "Failed to get queue info.")
-            return False
+            return None
 
-        if len(queue_info) != 1:
-            logMsg(ERROR, "Queue %s not found." % queue)
-            return False
+        queue_info = self.stat_cached(pbs_ifl.pbs_statque, QUEUE_ATTRS,
+                                      [queue], "queue")
+        if queue_info is None:
+            return None
 
-        queue_info = queue_info[0]
+        queue_info = queue_info[queue]
 
         if ("resources_max.walltime" in queue_info.keys()):
-            limit = self.human2sec(queue_info["resources_max.walltime"])
+            return human2sec(queue_info["resources_max.walltime"])
+
+        return 0
 
-            walltime = self.current_walltime + self.additional_walltime
+    def check_max_walltime(self, job):
+        """
+        Checks the queue max walltime limit
+        """
+
+        limit = self.queue_limit(job)
+        if limit is None:
+            return False
+
+        if limit > 0:
+            walltime = job.current_walltime + self.additional_walltime
 
             if walltime > limit:
                 return False
 
         return True
 
-    def check_moved_job(self, job_info):
+    def moved_server(self, job_info):
         """
-        Check moved job is suitable for walltime extension.
-        The extender is reconnect to suitableserver and
-        checks the job.
+        Returns the server the job has been moved to, None if unknown
         """
+
         if job_info["job_state"] != "M":
-            return False
+            return None
 
         if "queue" not in job_info.keys():
-            return False
+            return None
 
         a = job_info["queue"].split("@")
 
         if len(a) != 2:
-            return False
+            return None
 
         if len(a[1]) == 0:
+            return None
+
+        return a[1]
+
+    def check_moved_job(self, job_info):
+        """
+        Check moved job is suitable for walltime extension.
+        The extender is reconnect to suitableserver and
+        checks the job.
+        """
+
+        server_name = self.moved_server(job_info)
+        if server_name is None:
+            return False
+
+        self.hops += 1
+        if self.hops > MAX_MOVED_HOPS:
+            logMsg(ERROR, "The job %s has been moved too many times." %
+                   self.jobid)
             return False
 
         self.disconnect_server()
-        self.connect_server(a[1])
+        self.connect_server(server_name)
 
         return self.check_job()
 
-    def check_node_reservation(self, job_info, node_info):
+    def stat_cached(self, stat, attrs, names, what):
         """
-        Check node reservation violation.
+        Gets info of the named PBS objects through the status cache.
+        More missing objects are queried by a single stat
+        of all the objects of the server.
+        Returns dict name -> info, None on failure.
         """
 
-        if "queue" in node_info.keys():
-            if node_info["queue"] == "maintenance":
-                return False
+        infos = {}
+        missing = []
+        for name in names:
+            info = status_cache.get(self.server_host, what, name,
+                                    self.started)
+            if info is None:
+                missing.append(name)
+            else:
+                infos[name] = info
 
-            if node_info["queue"] == "reserved":
-                return False
+        if len(missing) > 0:
+            query = None
+            if len(missing) == 1:
+                query = missing[0]
 
-        if "resv" in node_info.keys():
-            resvs = node_info["resv"].split(", ")
-            for resv in resvs:
-                try:
-                    resv_info = pbs_ifl.pbs_statresv(self.c, resv, None, None)
-                except:
-                    logMsg(ERROR, "Failed to get reservation info.")
-                    return False
+            try:
+                with metrics.timer(stat.__name__):
+                    status = stat(self.c, query, create_attrl(attrs), None)
+            except:
+                logMsg(ERROR, "Failed to get %s info." % what)
+                return None
 
-                if len(resv_info) != 1:
-                    logMsg(ERROR, "Reservation %s not found." % resv)
-                    return False
+            status_cache.put(self.server_host, what, status)
 
-                resv_info = resv_info[0]
+            for name in missing:
+                info = status_cache.get(self.server_host, what, name,
+                                        self.started)
+                if info is None:
+                    logMsg(ERROR, "%s %s not found." %
+                           (what.capitalize(), name))
+                    return None
+                infos[name] = info
 
-                if not "stime" in job_info.keys():
-                    logMsg(ERROR, "Job %s misses start time. \
-Please, contact support." % self.jobid)
+        return infos
 
-                    return False
+    def job_nodes(self, job):
+        """
+        Returns the distinct vnodes of the job's exec_vnode,
+        the hosts of exec_host if it is missing
+        """
 
-                if "reserve_start" in resv_info.keys():
-                    end_time = int(job_info["stime"])
-                    end_time += self.current_walltime
-                    end_time += self.additional_walltime
+        vnodes = self.job_exec_vnode(job).vnodes()
+        if len(vnodes) > 0:
+            return vnodes
 
-                    if end_time > int(resv_info["reserve_start"]):
-                        logMsg(INFO, "Reservation %s in conflict." % resv)
-                        return False
-        return True
+        return parse_exec_host(job.job_info.get("exec_host", ""))
 
-    def check_reservations(self, job_info):
+    def reservation_horizon(self):
         """
-        Check nodes reservations violation.
+        Returns Reservation_horizon of the server, built from one stat
+        of all the reservations and cached as the status, None on failure
+        """
+
+        horizon = status_cache.get(self.server_host, "horizon", "",
+                                   self.started)
+        if horizon is not None:
+            return horizon
+
+        try:
+            with metrics.timer("pbs_statresv"):
+                resvs = pbs_ifl.pbs_statresv(self.c, None,
+                                             create_attrl(RESV_ATTRS), None)
+                horizon = Reservation_horizon(resvs)
+        except:
+            logMsg(ERROR, "Failed to get reservation info.")
+            return None
+
+        status_cache.put_object(self.server_host, "horizon", "", horizon)
+
+        return horizon
+
+    def reservation_extension(self, job):
+        """
+        Returns (largest extension in seconds, binding limit, reason)
+        of the job allowed by its nodes, the reservations on them and
+        the dedicated time, (None, None, None) if nothing binds,
+        None on failure.
+        A node blocked by the [nodes] policy allows no extension.
         """
 
+        job_info = job.job_info
+
         if job_info["job_state"] != "R":
-            return True
+            return (None, None, None)
 
-        nodes = set()
+        policy = self.node_policy
 
-        exec_host = job_info['exec_host']
-        for host in exec_host.split("+"):
-            host = host.split("/")[0]
-            nodes.add(host)
+        # the policy is evaluated in one pass over one stat of the nodes
+        nodes = self.job_nodes(job)
+        node_infos = self.stat_cached(pbs_ifl.pbs_statvnode, policy.attrs,
+                                      nodes, "node")
+        if node_infos is None:
+            return None
 
         for node in nodes:
-            try:
-                node_info = pbs_ifl.pbs_statvnode(self.c, node, None, None)
-            except:
-                logMsg(ERROR, "Failed to get node info.")
-                return False
+            reason = policy.blocking(node_infos[node])
+            if reason is not None:
+                return (0, NODE_BLOCKED, "node %s: %s" % (node, reason))
 
-            if len(node_info) != 1:
-                logMsg(ERROR, "Node %s not found." % node)
-                return False
+        horizon = self.reservation_horizon()
+        if horizon is None:
+            return None
 
-            node_info = node_info[0]
+        start, resv = horizon.earliest(nodes)
+        dedicated = len(policy.dedicated_windows()) > 0
+        if start is None and not dedicated:
+            return (None, None, None)
 
-            if not self.check_node_reservation(job_info, node_info):
-                return False
+        if not "stime" in job_info.keys():
+            logMsg(ERROR, "Job %s misses start time. \
+Please, contact support." % job.jobid,
+                   echo=not self.batch)
+            return None
+
+        stime = int(job_info["stime"])
+        end_time = stime + job.current_walltime
+
+        limit = (None, None, None)
+        if start is not None:
+            limit = (start, RESERVATION_CONFLICT, "reservation %s" % resv)
+
+        if dedicated:
+            # the job started before the dedicated time must end before it
+            ded_start = policy.dedicated_start(stime)
+            if ded_start is not None and \
+               (limit[0] is None or ded_start < limit[0]):
+                limit = (int(ded_start), DEDICATED_TIME,
+                         "dedicated time from %s" %
+                         datetime.fromtimestamp(ded_start))
+
+        if limit[0] is None:
+            return limit
+
+        return (max(limit[0] - end_time, 0), limit[1], limit[2])
+
+    def check_reservations(self, job):
+        """
+        Check nodes reservations violation.
+        """
+
+        limit = self.reservation_extension(job)
+        if limit is None:
+            return False
+
+        if limit[0] is not None and self.additional_walltime > limit[0]:
+            logMsg(INFO, "In conflict with %s." % limit[2],
+                   echo=not self.batch)
+            return False
 
         return True
 
@@ -859,6 +2587,9 @@ Please, contact support." % self.jobid)
         if not self.do_extension:
             return False
 
+        if self.batch:
+            return self.check_batch()
+
         if self.jobid is None or self.additional_walltime is None:
             return False
 
@@ -873,8 +2604,14 @@ Please, contact support." % self.jobid)
         if not self.db.is_connected():
             return False
 
+        attrs = create_attrl(JOB_ATTRS)
         try:
-            job_info = pbs_ifl.pbs_statjob(self.c, self.jobid, None, "x")
+            with metrics.timer("pbs_statjob"):
+                job_info = pbs_ifl.pbs_statjob(self.c, self.jobid, attrs, None)
+                if len(job_info) == 0:
+                    # finished or moved job is kept in the history only
+                    job_info = pbs_ifl.pbs_statjob(self.c, self.jobid, attrs,
+                                                   "x")
         except:
             logMsg(ERROR, "Failed to get job info.")
             return False
@@ -888,88 +2625,314 @@ Please, contact support." % self.jobid)
         if job_info["job_state"] == "M":
             return self.check_moved_job(job_info)
 
-        elif job_info["job_state"] == "F":
-            logMsg(INFO, "The job %s already finished." % self.jobid)
+        job = Job(self.jobid, self.affect_fund)
+        job.job_info = job_info
+        self.jobs = [job]
+
+        if not self.check_job_info(job):
             return False
 
+        return self.check_limits(self.jobs)
+
+    def check_job_info(self, job):
+        """
+        Checks the state, owner and resources of the job,
+        queue limit and node reservations
+        """
+
+        job_info = job.job_info
+
+        if job_info["job_state"] == "M":
+            return self.job_failed(job, MOVED, INFO,
+                                   "The job %s has been moved to %s." %
+                                   (job.jobid, job_info.get("queue", "")))
+
+        elif job_info["job_state"] == "F":
+            return self.job_failed(job, NOT_ALLOWED, INFO,
+                                   "The job %s already finished." % job.jobid)
+
         elif job_info["job_state"] == "Q":
             logMsg(INFO, "The job %s did not start yet. \
-Your cputime fund will not be affected." % self.jobid)
+Your cputime fund will not be affected." % job.jobid, echo=not self.batch)
 
-            self.affect_fund = False
+            job.affect_fund = False
             # no return here
 
         elif job_info["job_state"] != "R":
-            logMsg(INFO, "The job %s is not running." % self.jobid)
-            return False
+            return self.job_failed(job, NOT_ALLOWED, INFO,
+                                   "The job %s is not running." % job.jobid)
 
         if not self.admin and self.cmd_owner != job_info["Job_Owner"]:
-            logMsg(ERROR, "You are not the owner of the job.")
-            return False
+            return self.job_failed(job, NOT_ALLOWED, ERROR,
+                                   "You are not the owner of the job.")
 
         if "Resource_List.walltime" not in job_info.keys():
-            logMsg(ERROR, "Requested job %s misses the walltime resource."
-                   % self.jobid)
-            return False
+            return self.job_failed(job, INVALID_JOB, ERROR,
+                                   "Requested job %s misses the walltime \
+resource." % job.jobid)
 
-        self.current_walltime = self.human2sec(
+        job.current_walltime = human2sec(
             job_info["Resource_List.walltime"])
 
-        if self.affect_fund:
+        if job.affect_fund:
             if "exec_vnode" not in job_info.keys():
-                logMsg(ERROR, "Requested job %s misses the exec_vnode."
-                       % self.jobid)
-                return False
-            self.ncpus = self.get_ncpus(job_info["exec_vnode"])
+                return self.job_failed(job, INVALID_JOB, ERROR,
+                                       "Requested job %s misses the \
+exec_vnode." % job.jobid)
+            job.ncpus = self.get_ncpus(job)
+            job.rate, job.charge = self.charging.rate(
+                self.job_exec_vnode(job), job_info.get("queue", ""))
         else:
             # doesn't matter
-            self.ncpus = 1
+            job.ncpus = 1
 
-        if self.ncpus == 0:
-            logMsg(ERROR, "Failed to get ncpus from 'exec_vnode'.")
-            return False
+        if job.ncpus == 0:
+            return self.job_failed(job, INVALID_JOB, ERROR,
+                                   "Failed to get ncpus from 'exec_vnode'.")
 
-        if self.affect_fund and not self.check_count():
-            logMsg(INFO, f"Number of extensions {bcolors.FAIL}exceeds \
-%d{bcolors.ENDC}." % self.count)
+        # quote() computes the limits instead of checking them
+        if self.do_quote:
+            return True
 
-            self.show_info = True
+        if not job.affect_fund and \
+           not self.admin and \
+           not self.check_max_walltime(job):
+
+            return self.job_failed(job, QUEUE_LIMIT, INFO,
+                                   f"Requested walltime {bcolors.FAIL}violates \
+queue limit{bcolors.ENDC}.")
+
+        if not self.force and \
+            not self.check_reservations(job):
+            self.job_failed(job, RESERVATION_CONFLICT, INFO,
+                            f"Requested walltime {bcolors.FAIL}violates \
+node reservation{bcolors.ENDC}. Please, contact support.")
+
+            if not self.batch:
+                logMsg(INFO, "Admins can bypass this check by '-f' parameter.")
 
             return False
 
-        if self.affect_fund and not self.check_fund():
-            used_fund = self.db.get_used_fund(self.cmd_owner)
-            avail_walltime = (self.fund - used_fund) / self.ncpus
+        return True
+
+    def group_jobs(self):
+        """
+        Groups the requested jobids by the server to connect
+        """
 
-            logMsg(INFO, f"Requested walltime {bcolors.FAIL}exceeds %s's \
-cputime fund{bcolors.ENDC}." % self.cmd_owner)
+        groups = {}
 
-            print("Possible walltime extension for the job %s is %s." %
-                  (self.jobid, self.sec2human(avail_walltime)))
+        for jobid in self.jobids:
+            a = jobid.split("@")
+            server_name = None
+            if len(a) == 2 and len(a[1]) > 0:
+                server_name = a[1]
 
-            self.show_info = True
+            if server_name not in groups:
+                groups[server_name] = []
+            groups[server_name].append(a[0])
 
-            return False
+        return groups
 
-        if not self.affect_fund and \
-           not self.admin and \
-           not self.check_max_walltime(job_info):
+    def stat_jobs(self, jobids):
+        """
+        Gets info of all the jobids in one call,
+        job arrays are expanded to their subjobs.
+        The job history is queried only for jobids not found alive.
+        Every job is returned once, for the first requested jobid
+        matching it (a subjob given alone before its array).
+        Returns dict {requested_jobid: [job_info, ...]}
+        """
 
-            logMsg(INFO, f"Requested walltime {bcolors.FAIL}violates \
-queue limit{bcolors.ENDC}.")
+        jobids = list(dict.fromkeys(jobids))
+
+        found = {}
+        exact = {}
+        arrays = []
+        for jobid in jobids:
+            found[jobid] = []
+            if is_job_array(jobid):
+                arrays.append((jobid, array_range(jobid)))
+            else:
+                exact[jobid.split(".")[0]] = jobid
+
+        seen = set()
+        missing = jobids
+        for extend in ["t", "tx"]:
+            querying = set(missing)
+            for job_info in self.query_jobs(missing, extend):
+                if job_info.get("array") == "True":
+                    # array itself, its subjobs are listed separately
+                    continue
+
+                if job_info["id"] in seen:
+                    continue
+
+                seq = job_info["id"].split(".")[0]
+                jobid = exact.get(seq)
+                if jobid not in querying:
+                    jobid = None
+                    for requested, array in arrays:
+                        if requested in querying and \
+                           in_array_range(array, seq):
+                            jobid = requested
+                            break
+
+                if jobid is not None:
+                    seen.add(job_info["id"])
+                    found[jobid].append(job_info)
+
+            missing = [jobid for jobid in jobids if len(found[jobid]) == 0]
+            if len(missing) == 0:
+                break
+
+        return found
+
+    def query_jobs(self, jobids, extend):
+        """
+        Stats the jobids in one call, or one by one if the server
+        does not support job lists
+        """
+
+        attrs = create_attrl(JOB_ATTRS)
+
+        jobs_info = None
+        try:
+            with metrics.timer("pbs_statjob"):
+                jobs_info = pbs_ifl.pbs_statjob(self.c, ",".join(jobids),
+                                                attrs, extend)
+        except:
+            jobs_info = None
+
+        if not jobs_info and len(jobids) > 1:
+            # server without job list support
+            jobs_info = []
+            for jobid in jobids:
+                try:
+                    with metrics.timer("pbs_statjob"):
+                        jobs_info += pbs_ifl.pbs_statjob(self.c, jobid, attrs,
+                                                         extend)
+                except:
+                    logMsg(ERROR, "Failed to get job info.")
+
+        if jobs_info is None:
+            logMsg(ERROR, "Failed to get job info.")
+            jobs_info = []
 
+        return jobs_info
+
+    def check_server_jobs(self, server_name, jobids, moved):
+        """
+        Checks the jobs of the batch on one server.
+        Moved jobs are added to moved {server_name: [jobid, ...]}
+        unless moved is None.
+        """
+
+        self.connect_server(server_name)
+
+        jobids = ["%s.%s" % (jobid, self.server_host)
+                  if re.match(r'^[0-9]+(\[[0-9,-]*\])?$', jobid)
+                  else jobid for jobid in jobids]
+
+        if self.c is None:
+            for jobid in jobids:
+                job = Job(jobid, self.affect_fund)
+                job.server_name = server_name
+                self.jobs.append(job)
+                self.job_failed(job, SERVER_ERROR, ERROR,
+                                "No connection to server.")
+            return
+
+        found = self.stat_jobs(jobids)
+        self.stat_nodes([job_info for jobs_info in found.values()
+                         for job_info in jobs_info])
+
+        # a job reached again (moved back and forth) is checked once
+        known = set(job.jobid for job in self.jobs)
+
+        for jobid, jobs_info in found.items():
+            if len(jobs_info) == 0:
+                job = Job(jobid, self.affect_fund)
+                self.jobs.append(job)
+                self.job_failed(job, NOT_FOUND, ERROR,
+                                "Jobid %s not found." % jobid)
+                continue
+
+            for job_info in jobs_info:
+                if job_info["id"] in known:
+                    continue
+                known.add(job_info["id"])
+
+                target = self.moved_server(job_info)
+                if target is not None and moved is not None:
+                    moved.setdefault(target, []).append(job_info["id"])
+                    continue
+
+                job = Job(job_info["id"], self.affect_fund)
+                job.job_info = job_info
+                job.server_name = server_name
+                self.jobs.append(job)
+                self.check_job_info(job)
+
+    def check_groups(self):
+        """
+        Checks the jobs grouped by server, moved jobs
+        are looked up on their new servers
+        """
+
+        groups = self.group_jobs()
+        hops = 0
+        while len(groups) > 0:
+            moved = {}
+            for server_name, jobids in groups.items():
+                self.check_server_jobs(server_name, jobids,
+                                       moved if hops < MAX_MOVED_HOPS
+                                       else None)
+            groups = moved
+            hops += 1
+
+    def stat_nodes(self, jobs_info):
+        """
+        Gets the nodes of all the running jobs into the status cache
+        by one stat, so the node policy of each job is checked
+        without querying the server again
+        """
+
+        if self.force:
+            return
+
+        nodes = set()
+        for job_info in jobs_info:
+            if job_info["job_state"] == "R":
+                job = Job(job_info["id"], False)
+                job.job_info = job_info
+                nodes.update(self.job_nodes(job))
+
+        if len(nodes) > 1:
+            self.stat_cached(pbs_ifl.pbs_statvnode, self.node_policy.attrs,
+                             sorted(nodes), "node")
+
+    def check_batch(self):
+        """
+        Checks all the jobs of the batch,
+        one job stat per server and one limits check for all jobs.
+        Moved jobs are looked up on their new servers,
+        again one stat per server.
+        """
+
+        if self.additional_walltime == 0:
+            logMsg(ERROR, "Zero walltime is not allowed.")
             return False
 
-        if not self.force and \
-            not self.check_reservations(job_info):
-            logMsg(INFO, f"Requested walltime {bcolors.FAIL}violates \
-node reservation{bcolors.ENDC}. Please, contact support.")
+        if not self.db.is_connected():
+            return False
 
-            logMsg(INFO, "Admins can bypass this check by '-f' parameter.")
+        self.check_groups()
 
-            return False
+        checked = [job for job in self.jobs if job.result is None]
+        self.check_limits(checked)
 
-        return True
+        return len([job for job in self.jobs if job.result is None]) > 0
 
     def create_walltime_attr(self, walltime):
         """
@@ -984,6 +2947,46 @@ node reservation{bcolors.ENDC}. Please, contact support.")
 
         return a
 
+    def alter_job(self, job):
+        """
+        Sets the new walltime of the job
+        """
+
+        job.new_walltime = job.current_walltime + self.additional_walltime
+
+        attr_walltime = self.create_walltime_attr(
+                        sec2human(job.new_walltime))
+
+        # the fund is reserved before the alter,
+        # so the job is never extended without being charged
+        if job.affect_fund and \
+           not self.db.reserve_job(job.jobid, self.cmd_owner, job.cputime,
+                                   job.charge):
+            self.job_failed(job, SERVER_ERROR, ERROR,
+                            "Failed to reserve cputime fund.")
+            return 1
+
+        try:
+            with metrics.timer("pbs_alterjob"):
+                ret = pbs_ifl.pbs_alterjob(self.c, job.jobid, attr_walltime,
+                                           None)
+        except:
+            ret = 1
+
+        if ret != 0:
+            if job.affect_fund:
+                self.db.release_job()
+            self.job_failed(job, ALTER_FAILED, ERROR,
+                            "Failed to alter job. Error code: %d" % ret)
+            return ret
+
+        if job.affect_fund:
+            self.db.confirm_job()
+
+        job.result = GRANTED
+
+        return ret
+
     def extend(self):
         """
         Extends the job
@@ -991,27 +2994,27 @@ node reservation{bcolors.ENDC}. Please, contact support.")
 
         ret = 1
 
+        if self.batch:
+            return self.extend_batch()
+
         if self.c is None:
             logMsg(ERROR, "No connection to server.")
             return ret
 
-        self.new_walltime = self.current_walltime + self.additional_walltime
+        job = self.jobs[0]
 
-        attr_walltime = self.create_walltime_attr(
-                        self.sec2human(self.new_walltime))
+        ret = self.alter_job(job)
 
-        try:
-            ret = pbs_ifl.pbs_alterjob(self.c, self.jobid, attr_walltime, None)
-        except:
-            ret = 1
+        # committed before any output, a client gone meanwhile
+        # must not roll back the fund of the extended job
+        self.adjust_fund()
 
         if ret != 0:
-            logMsg(ERROR, "Failed to alter job. Error code: %d" % ret)
             return ret
 
         reduction = 0
-        if self.affect_fund:
-            reduction = self.additional_walltime * self.ncpus
+        if job.affect_fund:
+            reduction = job.cputime
             self.show_info = True
 
         logMsg(INFO, f"The walltime of the job %s {bcolors.OKGREEN}\
@@ -1020,27 +3023,258 @@ Additional walltime:\t%s\n\
 New walltime:\t\t%s\n\
 Fund affected:\t\t%s\n\
 Fund reduction:\t\t%s" %
-               (self.jobid,
-                self.sec2human(self.additional_walltime),
-                self.sec2human(self.new_walltime),
-                self.affect_fund,
-                self.sec2human(reduction)))
+               (job.jobid,
+                sec2human(self.additional_walltime),
+                sec2human(job.new_walltime),
+                job.affect_fund,
+                sec2human(reduction)))
 
         self.disconnect_server()
 
         return ret
 
+    def extend_batch(self):
+        """
+        Extends all the checked jobs of the batch
+        """
+
+        granted = []
+        for job in self.jobs:
+            if job.result is not None:
+                continue
+
+            self.connect_server(job.server_name)
+            if self.c is None:
+                self.job_failed(job, SERVER_ERROR, ERROR,
+                                "No connection to server.")
+                continue
+
+            if self.alter_job(job) == 0:
+                granted.append(job)
+
+        # committed before any output, see extend()
+        self.adjust_fund()
+
+        for job in granted:
+            logMsg(INFO, "The walltime of the job %s has been extended \
+by %s to %s, fund affected: %s." %
+                   (job.jobid, sec2human(self.additional_walltime),
+                    sec2human(job.new_walltime), job.affect_fund),
+                   echo=False)
+
+            if job.affect_fund:
+                self.show_info = True
+
+        # the report is printed for all the jobs at the end
+        return 0
+
+    def report(self):
+        """
+        Prints results of the batch extension.
+        Returns 0 if all the jobs have been extended.
+        """
+
+        if self.output_json and self.do_extension:
+            self.json_out["additional_walltime"] = self.additional_walltime
+            self.json_out["jobs"] = []
+            for job in self.jobs:
+                self.json_out["jobs"].append({
+                    "jobid": job.jobid,
+                    "result": job.result,
+                    "new_walltime": job.new_walltime
+                    if job.result == GRANTED else None,
+                    "fund_affected": job.affect_fund,
+                    "cputime": job.cputime
+                    if job.result == GRANTED and job.affect_fund else 0,
+                    "charge": job.charge
+                    if job.result == GRANTED and job.affect_fund else None,
+                    "message": job.message})
+
+        if not self.batch or not self.do_extension:
+            return 0
+
+        if self.output_json:
+            return self.batch_ret()
+
+        print("%-40s %-22s %-12s %s" %
+              ("Jobid", "Result", "New walltime", "Message"))
+        for job in self.jobs:
+            new_walltime = ""
+            if job.result == GRANTED:
+                new_walltime = sec2human(job.new_walltime)
+
+            print("%-40s %-22s %-12s %s" %
+                  (job.jobid, job.result, new_walltime, job.message))
+
+        granted = [job for job in self.jobs if job.result == GRANTED]
+        print()
+        print("Extended %d of %d jobs by %s." %
+              (len(granted), len(self.jobs),
+               sec2human(self.additional_walltime)))
+
+        return self.batch_ret()
+
+    def batch_ret(self):
+        """
+        Exit code of the batch extension
+        """
+
+        if len(self.jobs) == 0:
+            return 1
+
+        for job in self.jobs:
+            if job.result != GRANTED:
+                return 1
+
+        return 0
+
+    def bound(self, job, seconds, binding):
+        """
+        Lowers the largest extension of the job to seconds
+        """
+
+        if job.max_extension is None or seconds < job.max_extension:
+            job.max_extension = max(int(seconds), 0)
+            job.binding = binding
+
+    def quote(self):
+        """
+        Computes the largest extension of each job that would be granted
+        now and the limit binding it (fund, count, queue limit, node
+        reservations), the same one for all the jobs together.
+        Nothing is altered nor reserved. Returns the exit code.
+        """
+
+        if not self.do_quote:
+            return 0
+
+        if not self.db.is_connected():
+            return 1
+
+        self.check_groups()
+
+        used_count, used_fund, earliest_timeout = \
+            self.get_usage(self.cmd_owner)
+        if used_count < 0 or used_fund < 0:
+            # the failure has been reported by the database
+            return 1
+
+        avail_count = self.count - used_count
+        avail_fund = max(self.fund - used_fund, 0)
+
+        checked = []
+        for job in self.jobs:
+            if job.result is not None:
+                job.max_extension = 0
+                job.binding = job.result
+                continue
+
+            if job.affect_fund:
+                if avail_count < 1:
+                    self.bound(job, 0, COUNT_EXCEEDED)
+                if job.rate > 0:
+                    self.bound(job, avail_fund / job.rate, FUND_EXCEEDED)
+
+            if not job.affect_fund and not self.admin:
+                self.connect_server(job.server_name)
+                limit = self.queue_limit(job)
+                if limit is None:
+                    self.job_failed(job, SERVER_ERROR, ERROR,
+                                    "Failed to get the queue limit.")
+                    self.bound(job, 0, SERVER_ERROR)
+                    continue
+                if limit > 0:
+                    self.bound(job, limit - job.current_walltime,
+                               QUEUE_LIMIT)
+
+            if not self.force:
+                self.connect_server(job.server_name)
+                limit = self.reservation_extension(job)
+                if limit is None:
+                    self.job_failed(job, SERVER_ERROR, ERROR,
+                                    "Failed to check node reservations.")
+                    self.bound(job, 0, SERVER_ERROR)
+                    continue
+                if limit[1] is not None:
+                    self.bound(job, limit[0], limit[1])
+
+            checked.append(job)
+
+        # all the jobs together share the fund and count
+        common = Job(None, False)
+        if len(checked) == 0:
+            self.bound(common, 0, NOT_FOUND)
+        for job in checked:
+            if job.binding is not None and \
+               job.binding not in [FUND_EXCEEDED, COUNT_EXCEEDED]:
+                self.bound(common, job.max_extension, job.binding)
+
+        fund_jobs = [job for job in checked if job.affect_fund]
+        if len(fund_jobs) > avail_count:
+            self.bound(common, 0, COUNT_EXCEEDED)
+        rate = sum(job.rate for job in fund_jobs)
+        if rate > 0:
+            self.bound(common, avail_fund / rate, FUND_EXCEEDED)
+
+        self.print_quote(common)
+
+        if len(checked) < len(self.jobs):
+            return 1
+
+        return 0
+
+    def print_quote(self, common):
+        """
+        Prints the quote of the jobs
+        """
+
+        def human(seconds):
+            if seconds is None:
+                return "unlimited"
+            return sec2human(seconds)
+
+        if self.output_json:
+            self.json_out["quote"] = {
+                "max_extension": common.max_extension,
+                "binding": common.binding,
+                "jobs": [{"jobid": job.jobid,
+                          "result": job.result,
+                          "max_extension": job.max_extension,
+                          "binding": job.binding,
+                          "fund_affected": job.affect_fund,
+                          "ncpus": job.ncpus,
+                          "rate": job.rate,
+                          "message": job.message}
+                         for job in self.jobs]}
+            return
+
+        print("%-40s %-14s %-22s %s" %
+              ("Jobid", "Max extension", "Limited by", "Message"))
+        for job in self.jobs:
+            print("%-40s %-14s %-22s %s" %
+                  (job.jobid, human(job.max_extension), job.binding or "",
+                   job.message))
+
+        if len(self.jobs) > 1:
+            print()
+            print("All the jobs can be extended by %s%s." %
+                  (human(common.max_extension),
+                   " (limited by %s)" % common.binding
+                   if common.binding else ""))
+
     def reset_other_owner(self):
 
         if not self.reset_owner:
             return
 
-        if not re.match(self.owner_re, self.reset_owner):
+        if not self.rules.valid_owner(self.reset_owner):
             logMsg(ERROR, "Illegal format of principal.")
             self.print_help()
             return
 
         self.db.clean_owner(self.reset_owner)
+        self.usage.pop(self.reset_owner, None)
+        self.json_out["reset"] = self.reset_owner
 
         self.info_owner = self.reset_owner
         self.show_info = True
@@ -1057,31 +3291,59 @@ Fund reduction:\t\t%s" %
 
         if self.show_full_list and self.db.is_connected():
 
-            if len(self.list_re) == 0:
+            if not self.rules.listing_enabled():
                 logMsg(ERROR, "Listing users is disabled.")
                 return
 
-            if not re.match(self.list_re, self.cmd_owner):
+            if not self.rules.may_list(self.cmd_owner):
                 logMsg(ERROR, "No permission to list users.")
                 return
 
             full_list = {}
             full_list["clean_secs"] = self.clean_secs
-            if self.preparsed_fund:
-                full_list["cputime_fund_rules"] = self.preparsed_fund
-            if self.preparsed_count:
-                full_list["count_limit_rules"] = self.preparsed_count
-            full_list["list"] = {}
-            for item in self.db.get_full_list():
-                earliest_timeout = self.db.get_earliest_record_timeout(
-                    item[0], self.clean_secs)
-                full_list["list"][item[0]] = {}
-                full_list["list"][item[0]]["count"] = item[1]
-                full_list["list"][item[0]]["cputime"] = item[2]
-                full_list["list"][item[0]]["earliest_timeout"] \
-                    = "%s" % earliest_timeout
-
-            print(json.dumps(full_list, indent=4))
+            if self.rules.fund_rules.preparsed:
+                full_list["cputime_fund_rules"] = \
+                    self.rules.fund_rules.preparsed
+            if self.rules.count_rules.preparsed:
+                full_list["count_limit_rules"] = \
+                    self.rules.count_rules.preparsed
+
+            rows = self.db.get_full_list(self.clean_secs, self.list_filters)
+
+            # the JSON document is printed with the messages at the end,
+            # so it is not streamed, --ndjson is the streaming format
+            if self.output_json:
+                full_list["list"] = {}
+                for owner, count, cputime, earliest_timeout in rows:
+                    full_list["list"][owner] = {
+                        "count": count,
+                        "cputime": cputime,
+                        "earliest_timeout": "%s" % earliest_timeout}
+                self.json_out["list"] = full_list
+                return
+
+            if self.list_ndjson:
+                for owner, count, cputime, earliest_timeout in rows:
+                    print(json.dumps({"owner": owner,
+                                      "count": count,
+                                      "cputime": cputime,
+                                      "earliest_timeout":
+                                      "%s" % earliest_timeout}))
+                return
+
+            # the same document as a whole, written row by row
+            header = json.dumps(full_list, indent=4)
+            print(header[:-2] + ',\n    "list": {', end="")
+            sep = "\n"
+            for owner, count, cputime, earliest_timeout in rows:
+                print("%s        %s: %s" %
+                      (sep, json.dumps(owner),
+                       json.dumps({"count": count,
+                                   "cputime": cputime,
+                                   "earliest_timeout":
+                                   "%s" % earliest_timeout})), end="")
+                sep = ",\n"
+            print("\n    }\n}")
 
     def info(self):
         """
@@ -1099,61 +3361,578 @@ Fund reduction:\t\t%s" %
         if self.info_owner:
             owner = self.info_owner
 
-        if not re.match(self.owner_re, owner):
+        if not self.rules.valid_owner(owner):
             logMsg(ERROR, "Illegal format of principal.")
             self.print_help()
             return
 
         if self.db.is_connected():
             days = int(self.clean_secs / 86400)
-            used_count = self.db.get_used_count(owner)
-            used_fund = self.db.get_used_fund(owner)
-            earliest_timeout = self.db.get_earliest_record_timeout(
-                owner, self.clean_secs)
+            fund = self.rules.fund(owner)
+            count = self.rules.count(owner)
+            used_count, used_fund, earliest_timeout = self.get_usage(owner)
+
+            if self.output_json:
+                self.json_out["info"] = {
+                    "owner": owner,
+                    "period_secs": self.clean_secs,
+                    "count_limit": count,
+                    "used_count": used_count,
+                    "available_count": count - used_count,
+                    "fund": fund,
+                    "used_fund": used_fund,
+                    "available_fund": fund - used_fund,
+                    "earliest_timeout": "%s" % earliest_timeout
+                    if earliest_timeout else None}
+                return
+
             print()
             print("%s's info:" % owner)
             print()
             print("%d-days counter limit:\t%d" %
-                  (days, self.count))
+                  (days, count))
 
             print("Used counter limit:\t%d" % used_count)
 
             print("Avail. counter limit:\t%d" %
-                  (self.count - used_count))
+                  (count - used_count))
             print()
 
             print("%d-days cputime fund:\t%s" %
-                  (days, self.sec2human(self.fund)))
+                  (days, sec2human(fund)))
 
             print("Used cputime fund:\t%s" %
-                  self.sec2human(used_fund))
+                  sec2human(used_fund))
 
             print("Avail. cputime fund:\t%s" %
-                  self.sec2human((self.fund - used_fund)))
+                  sec2human((fund - used_fund)))
             print()
             print("Earliest rec. timeout:\t%s" %
                   earliest_timeout)
 
+    def count_metrics(self, ret, secs):
+        """
+        Counts the request and the outcomes of its jobs
+        """
+
+        command = self.command or "invalid"
+        metrics.inc("walltime_extender_requests_total",
+                    {"command": command, "ret": ret})
+        metrics.observe("walltime_extender_request_seconds",
+                        {"command": command}, secs)
+
+        if not self.do_extension:
+            return
+
+        for job in self.jobs:
+            metrics.inc("walltime_extender_jobs_total",
+                        {"result": job.result or SERVER_ERROR})
+
+    def print_json(self, ret):
+        """
+        Prints the results of the request in the JSON mode (--json)
+        """
+
+        if not self.output_json:
+            return
+
+        out = {}
+        out["command"] = self.command
+        out["ret"] = ret
+        out.update(self.json_out)
+        out["messages"] = request_ctx.messages
+        request_ctx.messages = None
+
+        print(json.dumps(out, indent=4))
+
     def finish(self):
         """
         Disconnect from db and pbs
         """
 
         self.disconnect_server()
+        self.disconnect_servers()
         if self.db:
-            self.db.disconnect()
+            # never leave a pooled connection inside a transaction
+            self.db.rollback()
+            if self.own_db:
+                self.db.disconnect()
 
-if __name__ == "__main__":
-    extender = Walltime_extender(sys.argv)
-    ret = 0
-    if extender.check_job():
-        ret = extender.extend()
-        if ret == 0:
-            extender.adjust_fund()
 
+def run(argv, db=None, conns=None):
+    """
+    Serves one request, returns the exit code
+    """
+
+    start = time.perf_counter()
+
+    extender = Walltime_extender(argv, db, conns)
+    ret = 1 if extender.invalid_args else 0
+    with metrics.timer("check_job"):
+        checked = extender.check_job()
+    if checked:
+        with metrics.timer("extend"):
+            ret = extender.extend()
+
+    # extend() commits the fund right after the alters,
+    # this releases the owner lock of the requests not extending
+    with metrics.timer("adjust_fund"):
+        extender.adjust_fund()
+
+    ret = extender.report() or ret
+    ret = extender.quote() or ret
     extender.reset_other_owner()
     extender.full_list()
     extender.info()
+    extender.print_json(ret)
 
     extender.finish()
-    exit(ret)
+    extender.count_metrics(ret, time.perf_counter() - start)
+    return ret
+
+
+class Request_stream(object):
+    """
+    Replacement of sys.stdout/sys.stderr in the daemon.
+    Forwards the output of the request served by the current thread
+    to its client, other output goes to the original stream.
+    """
+
+    def __init__(self, fd, fallback):
+        self.fd = fd
+        self.fallback = fallback
+
+    def write(self, data):
+        client = getattr(request_ctx, "client", None)
+        if client is None:
+            return self.fallback.write(data)
+
+        client.send_frame({"fd": self.fd, "data": data})
+        return len(data)
+
+    def flush(self):
+        if getattr(request_ctx, "client", None) is None:
+            self.fallback.flush()
+
+
+class Request_handler(socketserver.StreamRequestHandler):
+    """
+    Handles one client of the daemon.
+
+    The client sends one json line:
+    {"argv": [...], "env": {"REMOTE_USER": ..., "REMOTE_ADDR": ...},
+     "stdin": ...}
+    and receives json lines {"fd": 1|2, "data": ...} with the output,
+    finished by {"ret": <exit code>}.
+    """
+
+    def send_frame(self, frame):
+        self.wfile.write((json.dumps(frame) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline().decode())
+            argv = [TOOL_NAME] + [str(i) for i in req["argv"]]
+            env = req["env"]
+            stdin = req.get("stdin", "")
+        except:
+            logMsg(WARNING, "Malformed request from daemon client.")
+            return
+
+        worker = threading.current_thread()
+        db = None
+
+        request_ctx.env = env
+        request_ctx.stdin = stdin
+        request_ctx.client = self
+        request_ctx.errors = 0
+        ret = 1
+        try:
+            worker.prepare()
+            db = self.server.db_pool.get()
+            ret = run(argv, db, worker.conns)
+        except BrokenPipeError:
+            return
+        except Exception as e:
+            logMsg(ERROR, "Internal error: %s" % e)
+        finally:
+            if db is not None:
+                # the fund of the extended jobs is already committed,
+                # anything left open (owner lock) is dropped here
+                db.rollback()
+                self.server.db_pool.put(db)
+            request_ctx.client = None
+            request_ctx.env = None
+            request_ctx.stdin = None
+            request_ctx.messages = None
+            if request_ctx.errors > 0:
+                # the kept connections may be broken
+                worker.disconnect_servers()
+
+        try:
+            self.send_frame({"ret": ret})
+        except BrokenPipeError:
+            pass
+
+
+class Database_pool(object):
+    """
+    Database connections shared by the daemon threads.
+    The connections are opened on demand and kept open,
+    the last returned one is reused first.
+    """
+
+    def __init__(self, size):
+        self.free = queue.LifoQueue()
+        for i in range(size):
+            self.free.put(None)
+
+    def get(self):
+        db = self.free.get()
+
+        if db is None:
+            db = Database()
+            db.connect()
+        else:
+            db.reset()
+
+        return db
+
+    def put(self, db):
+        self.free.put(db)
+
+
+class Worker(threading.Thread):
+    """
+    Daemon worker thread keeping its own warm PBS connections
+    between the requests
+    """
+
+    def __init__(self, server, pbs_idle_secs):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.pbs_idle_secs = pbs_idle_secs
+        self.conns = {}
+        self.last_used = 0
+
+    def prepare(self):
+        """
+        Checks the kept connections before serving a request
+        """
+
+        if time.time() - self.last_used > self.pbs_idle_secs:
+            self.disconnect_servers()
+        self.last_used = time.time()
+
+    def disconnect_servers(self):
+        close_servers(self.conns)
+
+    def run(self):
+        while True:
+            request, client_address = self.server.requests.get()
+            try:
+                self.server.finish_request(request, client_address)
+            except:
+                pass
+            finally:
+                self.server.shutdown_request(request)
+
+
+class Extender_server(socketserver.UnixStreamServer):
+    """
+    Persistent walltime extender serving requests
+    forwarded by openpbs-walltime-extender-client over a unix socket
+    """
+
+    def __init__(self, path, workers, pbs_idle_secs, db_pool):
+        self.db_pool = db_pool
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path,
+                                                   Request_handler)
+        finally:
+            os.umask(old_umask)
+
+        self.requests = queue.Queue()
+        for i in range(workers):
+            Worker(self, pbs_idle_secs).start()
+
+    def verify_request(self, request, client_address):
+        # only root (remctld) and the daemon user may forward requests
+        creds = request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                   struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        return uid in (0, os.getuid())
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+def init_database():
+    """
+    Creates or migrates the database schema,
+    run on installation and upgrade
+    """
+
+    db = Database()
+    db.connect()
+    if not db.is_connected():
+        return 1
+
+    ret = db.check_schema()
+    db.disconnect()
+
+    return ret
+
+
+def maintain(db=None):
+    """
+    Expires records older than clean_secs.
+    Run periodically by the timer or by the daemon,
+    the requests only ignore the expired records.
+    """
+
+    own_db = db is None
+    if own_db:
+        db = Database()
+        db.connect()
+
+    if not db.is_connected():
+        return 1
+
+    try:
+        db.clean_old(get_rules().clean_secs)
+    except Exception as e:
+        logMsg(ERROR, "Maintenance failed: %s" % e)
+        return 1
+    finally:
+        if own_db:
+            db.disconnect()
+
+    return 0
+
+
+def check_usage():
+    """
+    Rebuilds the usage summary from the records
+    """
+
+    db = Database()
+    db.connect()
+    if not db.is_connected():
+        return 1
+
+    inconsistent = db.check_usage()
+    db.disconnect()
+
+    if inconsistent < 0:
+        return 1
+
+    logMsg(INFO, "Usage summary rebuilt, %d inconsistent owners found."
+           % inconsistent)
+
+    return 0
+
+
+class Metrics_handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the metrics on GET /metrics
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Metrics_server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Threading HTTP server of the metrics
+    """
+
+    daemon_threads = True
+
+
+class Metrics_exporter(threading.Thread):
+    """
+    Daemon thread exporting the metrics to the textfile
+    of the node exporter textfile collector periodically
+    and/or over HTTP
+    """
+
+    def __init__(self, textfile, textfile_secs, listen):
+        threading.Thread.__init__(self, daemon=True)
+        self.textfile = textfile
+        self.textfile_secs = textfile_secs
+        self.httpd = None
+
+        if listen:
+            host, port = listen.rsplit(":", 1)
+            self.httpd = Metrics_server((host, int(port)), Metrics_handler)
+            threading.Thread(target=self.httpd.serve_forever,
+                             daemon=True).start()
+
+    def write_textfile(self):
+        tmp = "%s.%d" % (self.textfile, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                f.write(metrics.render())
+            os.rename(tmp, self.textfile)
+        except OSError as e:
+            logMsg(ERROR, "Failed to write metrics: %s" % e)
+
+    def run(self):
+        if not self.textfile:
+            return
+
+        while True:
+            self.write_textfile()
+            time.sleep(self.textfile_secs)
+
+
+class Maintainer(threading.Thread):
+    """
+    Daemon thread running maintain() periodically
+    """
+
+    def __init__(self, maintenance_secs, db_pool):
+        threading.Thread.__init__(self, daemon=True)
+        self.maintenance_secs = maintenance_secs
+        self.db_pool = db_pool
+
+    def run(self):
+        while True:
+            db = self.db_pool.get()
+            try:
+                maintain(db)
+            finally:
+                self.db_pool.put(db)
+            time.sleep(self.maintenance_secs)
+
+
+def daemon_config():
+    """
+    Returns the daemon section of the config, empty if missing
+    """
+
+    try:
+        return config(section="daemon")
+    except:
+        return {}
+
+
+def serve():
+    """
+    Runs the persistent extender
+    """
+
+    if remote_env("REMOTE_USER"):
+        logMsg(ERROR, "The daemon can not be started remotely.")
+        return 1
+
+    try:
+        get_rules()
+    except Exception as e:
+        logMsg(ERROR, "Invalid configuration: %s" % e)
+        return 1
+
+    cfg = daemon_config()
+
+    path = cfg.get("socket", DAEMON_SOCKET)
+    workers = int(cfg.get("workers", 8))
+    pbs_idle_secs = int(cfg.get("pbs_idle_secs", 60))
+    status_cache.ttl = int(cfg.get("status_ttl", 30))
+    maintenance_secs = int(cfg.get("maintenance_secs", 3600))
+
+    pool_size = workers
+    try:
+        pool_size = int(config(section="database").get("pool_size",
+                                                        workers))
+    except:
+        pass
+
+    db_pool = Database_pool(pool_size)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    server = Extender_server(path, workers, pbs_idle_secs, db_pool)
+
+    if maintenance_secs > 0:
+        Maintainer(maintenance_secs, db_pool).start()
+
+    metrics_cfg = {}
+    try:
+        metrics_cfg = config(section="metrics")
+    except:
+        pass
+
+    if metrics_cfg.get("textfile") or metrics_cfg.get("listen"):
+        try:
+            Metrics_exporter(metrics_cfg.get("textfile"),
+                             int(metrics_cfg.get("textfile_secs", 60)),
+                             metrics_cfg.get("listen")).start()
+        except Exception as e:
+            logMsg(ERROR, "Failed to export metrics: %s" % e)
+
+    sys.stdout = Request_stream(1, sys.stdout)
+    sys.stderr = Request_stream(2, sys.stderr)
+
+    def terminate(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    def hangup(signum, frame):
+        reload_config()
+        try:
+            get_rules()
+            status_cache.ttl = int(daemon_config().get("status_ttl", 30))
+        except Exception as e:
+            logMsg(ERROR, "Invalid configuration: %s" % e)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, hangup)
+
+    logMsg(INFO, "Listening on %s with %d workers." % (path, workers))
+    server.serve_forever()
+    server.server_close()
+    os.unlink(path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "--daemon":
+        exit(serve())
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--init-database":
+        if remote_env("REMOTE_USER"):
+            logMsg(ERROR, "The database can not be initialized remotely.")
+            exit(1)
+        exit(init_database())
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--check-usage":
+        if remote_env("REMOTE_USER"):
+            logMsg(ERROR, "The usage check can not be run remotely.")
+            exit(1)
+        exit(check_usage())
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--maintenance":
+        if remote_env("REMOTE_USER"):
+            logMsg(ERROR, "The maintenance can not be run remotely.")
+            exit(1)
+        exit(maintain())
+
+    exit(run(sys.argv))
@@ -29,34 +29,51 @@ install -D -m 644 openpbs-walltime-extender.service %{buildroot}%{_unitdir}/open
 install -D -m 644 openpbs-walltime-extender.conf %{buildroot}/opt/pbs/etc/openpbs-walltime-extender.conf
 install -D -m 744 openpbs-walltime-extender.py %{buildroot}/opt/pbs/bin/openpbs-walltime-extender.py
 install -D -m 744 openpbs-walltime-extender %{buildroot}/opt/pbs/bin/openpbs-walltime-extender
+install -D -m 744 openpbs-walltime-extender-client.py %{buildroot}/opt/pbs/bin/openpbs-walltime-extender-client.py
+install -D -m 644 openpbs-walltime-extenderd.service %{buildroot}%{_unitdir}/openpbs-walltime-extenderd.service
+install -D -m 644 openpbs-walltime-extender-maintenance.service %{buildroot}%{_unitdir}/openpbs-walltime-extender-maintenance.service
+install -D -m 644 openpbs-walltime-extender-maintenance.timer %{buildroot}%{_unitdir}/openpbs-walltime-extender-maintenance.timer
 install -D -m 644 _pbs_ifl.so %{buildroot}/opt/pbs/lib/python3-pbs_ifl/_pbs_ifl.so
 install -D -m 644 pbs_ifl.py %{buildroot}/opt/pbs/lib/python3-pbs_ifl/pbs_ifl.py
 install -D -m 644 openpbs-walltime-extender.remctl %{buildroot}/etc/remctl/conf.d/openpbs-walltime-extender
 
 %post
 %systemd_post openpbs-walltime-extender.service
+%systemd_post openpbs-walltime-extenderd.service
+%systemd_post openpbs-walltime-extender-maintenance.timer
 if [ ! -d /opt/pbs/var/postgresql/openpbs-walltime-extender ] ; then
     mkdir -p /opt/pbs/var/postgresql
     chown postgres:postgres /opt/pbs/var/postgresql/ -R
     sudo -u postgres POSTGRESQL_PATH_HERE/initdb -D /opt/pbs/var/postgresql/openpbs-walltime-extender/
     sudo -u postgres POSTGRESQL_PATH_HERE/pg_ctl -D /opt/pbs/var/postgresql/openpbs-walltime-extender/ -o '-p 5455' start -w
     sudo -u postgres psql -h localhost -p 5455 -c 'CREATE DATABASE walltime_extender;'
+    LD_LIBRARY_PATH=/opt/pbs/lib:/usr/lib /opt/pbs/bin/openpbs-walltime-extender.py --init-database
     sudo -u postgres POSTGRESQL_PATH_HERE/pg_ctl -D /opt/pbs/var/postgresql/openpbs-walltime-extender/ stop -w
+elif systemctl is-active --quiet openpbs-walltime-extender ; then
+    LD_LIBRARY_PATH=/opt/pbs/lib:/usr/lib /opt/pbs/bin/openpbs-walltime-extender.py --init-database || true
 fi
 
 %preun
 %systemd_preun openpbs-walltime-extender.service
+%systemd_preun openpbs-walltime-extenderd.service
+%systemd_preun openpbs-walltime-extender-maintenance.timer
 
 %postun
 %systemd_postun_with_restart openpbs-walltime-extender.service
+%systemd_postun_with_restart openpbs-walltime-extenderd.service
+%systemd_postun openpbs-walltime-extender-maintenance.timer
 
 %files
 /opt/pbs/bin/openpbs-walltime-extender
 /opt/pbs/bin/openpbs-walltime-extender.py
+/opt/pbs/bin/openpbs-walltime-extender-client.py
 /opt/pbs/lib/python3-pbs_ifl/_pbs_ifl.so
 /opt/pbs/lib/python3-pbs_ifl/pbs_ifl.py
 /etc/remctl/conf.d/openpbs-walltime-extender
 %{_unitdir}/openpbs-walltime-extender.service
+%{_unitdir}/openpbs-walltime-extenderd.service
+%{_unitdir}/openpbs-walltime-extender-maintenance.service
+%{_unitdir}/openpbs-walltime-extender-maintenance.timer
 %config /opt/pbs/etc/openpbs-walltime-extender.conf
 %exclude /opt/pbs/lib/python3-pbs_ifl/pbs_ifl.pyc
 %exclude /opt/pbs/lib/python3-pbs_ifl/pbs_ifl.pyo
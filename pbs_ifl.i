@@ -1,4 +1,44 @@
 %module pbs_ifl
+%{
+#include "pbs_ifl.h"
+
+#define BATCH_STATUS "pbs_ifl.batch_status"
+#define BATCH_STATUS_ITEM "pbs_ifl.batch_status_item"
+
+static void batch_status_free(PyObject *capsule)
+{
+    struct batch_status *bs;
+
+    bs = (struct batch_status *) PyCapsule_GetPointer(capsule, BATCH_STATUS);
+    if (bs != NULL)
+        pbs_statfree(bs);
+}
+
+/* matches the attribute with "name" or "name.resource" key */
+static int attr_match(struct attrl *attr, const char *key)
+{
+    size_t len;
+
+    len = strlen(attr->name);
+    if (strncmp(attr->name, key, len) != 0)
+        return 0;
+
+    if (attr->resource == NULL)
+        return key[len] == '\0';
+
+    return key[len] == '.' && strcmp(attr->resource, key + len + 1) == 0;
+}
+
+static PyObject *attr_value(struct attrl *attr)
+{
+    const char *value;
+
+    value = attr->value != NULL ? attr->value : "";
+
+    return PyUnicode_DecodeUTF8(value, strlen(value), "replace");
+}
+%}
+
 %typemap(out) char ** {
   int len,i;
   len = 0;
@@ -30,62 +70,201 @@
     return NULL;
   }
 }
+/*
+ * Status of PBS objects is returned as a list of lazy mappings over
+ * the C list (see batch_status_info below), the attribute values are
+ * decoded only when accessed. The list is released by pbs_statfree()
+ * as soon as the last object referencing it is released.
+ */
 %typemap(out) struct batch_status * {
-    struct batch_status *head_bs, *bs;
-    struct attrl *attribs;
-    char *resource;
-    char *str;
-    int i, j;
-    int len;
-    char buf[4096];
-    static char *id = "id";
-    head_bs = $1;
-    bs = $1;
-    for (len=0; bs != NULL; len++)
-        bs = bs->next;
-    $result = PyList_New(len);
-    bs = head_bs;
-    for (i=0; i < len; i++) {
-        PyObject *dict;
-        PyObject *a, *v, *tmpv;
-        dict = PyDict_New();
-        PyList_SetItem($result, i, dict);
-        a = PyString_FromString(id);
-        v = PyString_FromString(bs->name);
-        PyDict_SetItem(dict, a, v);
-        attribs = bs->attribs;
-        while (attribs) {
-            resource = attribs->resource;
-            if (resource != NULL) {
-                str = malloc(strlen(attribs->name) + strlen(resource) + 2);
-                sprintf(str, "%s.%s", attribs->name, attribs->resource);
-                a = PyString_FromString(str);
-            }
-            else {
-                a = PyString_FromString(attribs->name);
-            }
-            tmpv = PyDict_GetItem(dict, a);
-            if (tmpv != NULL) {
-                PyObject *tmp_bytes = PyUnicode_AsEncodedString(tmpv, "UTF-8", "strict");
-                if (tmp_bytes != NULL) {
-                  char *s = PyBytes_AS_STRING(tmp_bytes);
-                  str = malloc(strlen(attribs->value) + strlen(s) + 4);
-                  sprintf(str, "%s,%s", attribs->value, s);
-                  v = PyString_FromString(str);
-                } else {
-                  v = PyString_FromString(attribs->value);
-                }
-            }
-            else {
-                v = PyString_FromString(attribs->value);
-            }
-            PyDict_SetItem(dict, a, v);
-            attribs = attribs->next;
+    if ($1 == NULL) {
+        $result = PyList_New(0);
+    } else {
+        $result = PyCapsule_New($1, BATCH_STATUS, batch_status_free);
+    }
+}
+
+/* the members would return the list owned by another capsule */
+%ignore batch_status::next;
+
+%define LAZY_STATUS(function)
+%feature("pythonappend") function %{
+    val = _batch_status_list(val)
+%}
+%enddef
+
+LAZY_STATUS(pbs_statjob)
+LAZY_STATUS(pbs_selstat)
+LAZY_STATUS(pbs_statque)
+LAZY_STATUS(pbs_statserver)
+LAZY_STATUS(pbs_statsched)
+LAZY_STATUS(pbs_stathost)
+LAZY_STATUS(pbs_statnode)
+LAZY_STATUS(pbs_statvnode)
+LAZY_STATUS(pbs_statresv)
+LAZY_STATUS(pbs_stathook)
+LAZY_STATUS(pbs_statrsc)
+
+%include "pbs_ifl.h"
+
+%inline %{
+/* returns [(name, item), ...] of the objects of the list */
+PyObject *_batch_status_objects(PyObject *head)
+{
+    struct batch_status *bs;
+    PyObject *list, *item;
+
+    bs = (struct batch_status *) PyCapsule_GetPointer(head, BATCH_STATUS);
+    if (bs == NULL)
+        return NULL;
+
+    list = PyList_New(0);
+    if (list == NULL)
+        return NULL;
+
+    for (; bs != NULL; bs = bs->next) {
+        item = Py_BuildValue("(sN)", bs->name,
+                             PyCapsule_New(bs, BATCH_STATUS_ITEM, NULL));
+        if (item == NULL || PyList_Append(list, item) < 0) {
+            Py_XDECREF(item);
+            Py_DECREF(list);
+            return NULL;
         }
-        bs = bs->next;
+        Py_DECREF(item);
     }
+
+    return list;
 }
-%{
-#include "pbs_ifl.h"
+
+/* returns all the values of the key, in the order of the list */
+PyObject *_batch_status_get(PyObject *item, const char *key)
+{
+    struct batch_status *bs;
+    struct attrl *attr;
+    PyObject *values, *value;
+
+    bs = (struct batch_status *) PyCapsule_GetPointer(item, BATCH_STATUS_ITEM);
+    if (bs == NULL)
+        return NULL;
+
+    values = PyList_New(0);
+    if (values == NULL)
+        return NULL;
+
+    for (attr = bs->attribs; attr != NULL; attr = attr->next) {
+        if (!attr_match(attr, key))
+            continue;
+
+        value = attr_value(attr);
+        if (value == NULL || PyList_Append(values, value) < 0) {
+            Py_XDECREF(value);
+            Py_DECREF(values);
+            return NULL;
+        }
+        Py_DECREF(value);
+    }
+
+    return values;
+}
+
+/* returns the keys of the object, duplicates included */
+PyObject *_batch_status_keys(PyObject *item)
+{
+    struct batch_status *bs;
+    struct attrl *attr;
+    PyObject *keys, *key;
+
+    bs = (struct batch_status *) PyCapsule_GetPointer(item, BATCH_STATUS_ITEM);
+    if (bs == NULL)
+        return NULL;
+
+    keys = PyList_New(0);
+    if (keys == NULL)
+        return NULL;
+
+    for (attr = bs->attribs; attr != NULL; attr = attr->next) {
+        if (attr->resource != NULL)
+            key = PyUnicode_FromFormat("%s.%s", attr->name, attr->resource);
+        else
+            key = PyUnicode_FromString(attr->name);
+
+        if (key == NULL || PyList_Append(keys, key) < 0) {
+            Py_XDECREF(key);
+            Py_DECREF(keys);
+            return NULL;
+        }
+        Py_DECREF(key);
+    }
+
+    return keys;
+}
+%}
+
+%pythoncode %{
+from collections.abc import Mapping as _Mapping
+
+
+class batch_status_info(_Mapping):
+    """
+    Status of one PBS object as a read-only mapping of
+    "name" or "name.resource" to the value, "id" is the object name.
+    Values are decoded on access, repeated attributes are joined
+    by commas (last one first).
+    """
+
+    __slots__ = ("_head", "_item", "_values", "id")
+
+    def __init__(self, head, name, item):
+        self._head = head
+        self._item = item
+        self._values = None
+        self.id = name
+
+    def __getitem__(self, key):
+        if key == "id":
+            return self.id
+
+        if self._values is None:
+            self._values = {}
+        elif key in self._values:
+            return self._values[key]
+
+        values = _batch_status_get(self._item, key)
+        if len(values) == 0:
+            raise KeyError(key)
+
+        values.reverse()
+        value = ",".join(values)
+        self._values[key] = value
+
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        yield "id"
+        seen = set()
+        for key in _batch_status_keys(self._item):
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _batch_status_list(head):
+    if isinstance(head, list):
+        return head
+
+    return [batch_status_info(head, name, item)
+            for name, item in _batch_status_objects(head)]
 %}
-%include "pbs_ifl.h"
\ No newline at end of file
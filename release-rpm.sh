@@ -10,9 +10,13 @@ make
 cp openpbs-walltime-extender.spec openpbs-walltime-extender-$VERSION/
 cp openpbs-walltime-extender.py openpbs-walltime-extender-$VERSION/
 cp openpbs-walltime-extender openpbs-walltime-extender-$VERSION/
+cp openpbs-walltime-extender-client.py openpbs-walltime-extender-$VERSION/
 cp openpbs-walltime-extender.conf openpbs-walltime-extender-$VERSION/
 cp openpbs-walltime-extender.remctl openpbs-walltime-extender-$VERSION/
 cp debian/openpbs-walltime-extender.service openpbs-walltime-extender-$VERSION/
+cp openpbs-walltime-extenderd.service openpbs-walltime-extender-$VERSION/
+cp openpbs-walltime-extender-maintenance.service openpbs-walltime-extender-$VERSION/
+cp openpbs-walltime-extender-maintenance.timer openpbs-walltime-extender-$VERSION/
 cp _pbs_ifl.so openpbs-walltime-extender-$VERSION/
 cp pbs_ifl.py openpbs-walltime-extender-$VERSION/
 